@@ -0,0 +1,221 @@
+import argparse
+import csv
+import gc
+import itertools
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+from tileset import Tileset
+from wavefunction_collapse import ChunkedGenerator
+
+# One point of the parameter grid
+Case = namedtuple("Case", "dimensions chunk_dimensions num_threads engine selection tileset")
+# What a case is matched on when comparing two result files
+KEY_FIELDS = ("width", "height", "chunk_width", "chunk_height", "num_threads", "engine", "selection", "tileset")
+# Key fields that older result files don't have, and what they were then
+KEY_DEFAULTS = {"selection": "scanline"}
+# Fields kept as strings when reading csv
+TEXT_FIELDS = {"engine", "selection", "tileset"}
+SUMMARY_FIELDS = ("median", "mean", "min", "max", "p10", "p90", "stdev")
+CSV_FIELDS = KEY_FIELDS + ("repeats",) + SUMMARY_FIELDS + ("peak_bytes",)
+
+
+def parameter_grid(sizes: list[int], chunk_sizes: list[int], workers: list[int], engines: list[str], tilesets: list[str], selections: list[str] = ("scanline",)):
+    """Every combination of square map sizes, square chunk sizes, worker counts, engines, selection modes and tileset files."""
+    return [Case((size, size), (chunk_size, chunk_size), num_threads, engine, selection, tileset)
+            for tileset, engine, selection, size, chunk_size, num_threads
+            in itertools.product(tilesets, engines, selections, sizes, chunk_sizes, workers)
+            if chunk_size <= size]
+
+
+def percentile(times: list[float], fraction: float):
+    """The value fraction of the way through times, interpolating between neighbours."""
+    ordered = sorted(times)
+    position = (len(ordered) - 1) * fraction
+    below = int(position)
+    above = min(below + 1, len(ordered) - 1)
+    return ordered[below] + (ordered[above] - ordered[below]) * (position - below)
+
+
+def summarize(times: list[float]):
+    return {
+        "repeats": len(times),
+        "median": statistics.median(times),
+        "mean": statistics.fmean(times),
+        "min": min(times),
+        "max": max(times),
+        "p10": percentile(times, 0.1),
+        "p90": percentile(times, 0.9),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+    }
+
+
+def run_case(case: Case, warmup: int = 1, repeats: int = 5, seed: int = 0, measure_memory: bool = True):
+    """
+        Times map_generation_chunked for one case. The worker pool is
+        started before timing, and the warmup runs are thrown away, so
+        only generation itself is measured. Every run uses the same seed,
+        so they all generate the same map.
+        Peak memory comes from one more run under tracemalloc, kept
+        separate because tracing slows generation down. It only counts
+        this process, not the workers.
+    """
+    tileset = Tileset.parse_json(case.tileset)
+    times = []
+    with ChunkedGenerator(tileset, case.num_threads, case.engine, case.selection) as generator:
+        for run in range(warmup + repeats):
+            gc.collect()
+            start = time.perf_counter()
+            generator.generate(case.dimensions, case.chunk_dimensions, seed=seed)
+            elapsed = time.perf_counter() - start
+            if run >= warmup:
+                times.append(elapsed)
+        peak_bytes = None
+        if measure_memory:
+            gc.collect()
+            tracemalloc.start()
+            try:
+                generator.generate(case.dimensions, case.chunk_dimensions, seed=seed)
+                peak_bytes = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    result = {
+        "width": case.dimensions[0],
+        "height": case.dimensions[1],
+        "chunk_width": case.chunk_dimensions[0],
+        "chunk_height": case.chunk_dimensions[1],
+        "num_threads": case.num_threads,
+        "engine": case.engine,
+        "selection": case.selection,
+        "tileset": case.tileset,
+        "seed": seed,
+        "warmup": warmup,
+        "times": times,
+        "peak_bytes": peak_bytes,
+    }
+    result.update(summarize(times))
+    return result
+
+
+def run_benchmarks(cases: list[Case], warmup: int = 1, repeats: int = 5, seed: int = 0, measure_memory: bool = True, log=sys.stderr):
+    results = []
+    for i, case in enumerate(cases):
+        result = run_case(case, warmup, repeats, seed, measure_memory)
+        results.append(result)
+        if log is not None:
+            print(f"[{i + 1}/{len(cases)}] {case_name(result)}: median {result['median']:.4f}s "
+                  f"(p10 {result['p10']:.4f}s, p90 {result['p90']:.4f}s)", file=log)
+    return results
+
+
+def case_name(result: dict):
+    return (f"{result['width']}x{result['height']} chunks {result['chunk_width']}x{result['chunk_height']} "
+            f"{result['num_threads']} workers {result['engine']} {result.get('selection', 'scanline')} "
+            f"{os.path.basename(result['tileset'])}")
+
+
+def save_results(results: list[dict], path: str):
+    """Writes results as json, with the machine they ran on, or as csv if path ends in .csv."""
+    if path.endswith(".csv"):
+        with open(path, "w", newline="") as output_file:
+            writer = csv.DictWriter(output_file, CSV_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(results)
+        return
+    environment = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    with open(path, "w") as output_file:
+        json.dump({"environment": environment, "results": results}, output_file, indent=2)
+
+
+def load_results(path: str):
+    if path.endswith(".csv"):
+        with open(path, newline="") as input_file:
+            results = list(csv.DictReader(input_file))
+        for result in results:
+            for field in CSV_FIELDS:
+                if field in TEXT_FIELDS or result.get(field) in {None, ""}:
+                    continue
+                result[field] = float(result[field]) if field in SUMMARY_FIELDS else int(result[field])
+        return results
+    with open(path) as input_file:
+        return json.load(input_file)["results"]
+
+
+def result_key(result: dict):
+    return tuple(result.get(field, KEY_DEFAULTS.get(field)) for field in KEY_FIELDS)
+
+
+def compare_results(baseline: list[dict], current: list[dict], threshold: float = 0.1):
+    """
+        Matches up the cases two runs share and compares their medians.
+        A case is a regression if it got more than threshold (a fraction)
+        slower. Returns one dict per shared case, slowest change first.
+    """
+    baseline_by_key = {result_key(result): result for result in baseline}
+    rows = []
+    for result in current:
+        before = baseline_by_key.get(result_key(result))
+        if before is None:
+            continue
+        change = result["median"] / before["median"] - 1
+        rows.append({
+            "case": case_name(result),
+            "baseline": before["median"],
+            "current": result["median"],
+            "change": change,
+            "regression": change > threshold,
+        })
+    rows.sort(key=lambda row: row["change"], reverse=True)
+    return rows
+
+
+def print_comparison(rows: list[dict], stream=sys.stdout):
+    for row in rows:
+        flag = "REGRESSION" if row["regression"] else ""
+        print(f"{row['case']}: {row['baseline']:.4f}s -> {row['current']:.4f}s ({row['change']:+.1%}) {flag}".rstrip(), file=stream)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks chunked map generation, or compares two benchmark results.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="time a grid of cases")
+    run.add_argument("--sizes", type=int, nargs="+", default=[64, 128, 256])
+    run.add_argument("--chunk-sizes", type=int, nargs="+", default=[32])
+    run.add_argument("--workers", type=int, nargs="+", default=[1, 4])
+    run.add_argument("--engines", nargs="+", default=["scalar"])
+    run.add_argument("--selections", nargs="+", default=["scanline"], choices=["scanline", "domain_size", "entropy"])
+    run.add_argument("--tilesets", nargs="+", default=["default_tileset.json"])
+    run.add_argument("--warmup", type=int, default=1)
+    run.add_argument("--repeats", type=int, default=5)
+    run.add_argument("--seed", type=int, default=0)
+    run.add_argument("--no-memory", action="store_true", help="skip the tracemalloc run")
+    run.add_argument("--output", default="benchmark.json", help=".json or .csv")
+    compare = commands.add_parser("compare", help="compare two result files")
+    compare.add_argument("baseline")
+    compare.add_argument("current")
+    compare.add_argument("--threshold", type=float, default=0.1, help="slowdown counted as a regression, as a fraction")
+    options = parser.parse_args(arguments)
+
+    if options.command == "run":
+        cases = parameter_grid(options.sizes, options.chunk_sizes, options.workers, options.engines, options.tilesets, options.selections)
+        results = run_benchmarks(cases, options.warmup, options.repeats, options.seed, not options.no_memory)
+        save_results(results, options.output)
+        return 0
+    rows = compare_results(load_results(options.baseline), load_results(options.current), options.threshold)
+    print_comparison(rows)
+    # A non-zero exit lets scripts fail on a regression
+    return 1 if any(row["regression"] for row in rows) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+import functools
+import time
+import instrumentation
+from position import Position
+
+
+def spans_touch(start_a: int, length_a: int, start_b: int, length_b: int, size: int, looping: bool):
+    """
+        Whether two spans on one axis overlap once a is grown by a cell on
+        each side, i.e. whether a job on a could read a cell b writes.
+    """
+    shifts = (-size, 0, size) if looping else (0,)
+    for shift in shifts:
+        start = start_b + shift
+        if start_a - 1 < start + length_b and start < start_a + length_a + 1:
+            return True
+    return False
+
+
+def jobs_conflict(a: tuple[Position, tuple[int, int]], b: tuple[Position, tuple[int, int]], dimensions: tuple[int, int], looping: bool):
+    """Whether a reads its border from cells b writes, or the other way around."""
+    return (spans_touch(a[0].x, a[1][0], b[0].x, b[1][0], dimensions[0], looping)
+            and spans_touch(a[0].y, a[1][1], b[0].y, b[1][1], dimensions[1], looping))
+
+
+class WaveScheduler:
+    """
+        Splits chunk jobs into waves of jobs that can run at the same time.
+        Two jobs conflict when one's border overlaps the other, including
+        diagonally, and conflicting jobs never share a wave.
+        Jobs are coloured greedily, taking them by the parity of their column
+        and row, which gives the usual four colour tiling for a grid of jobs.
+        A looping map with an odd number of columns or rows needs more.
+    """
+    def __init__(self, jobs: list[tuple[Position, tuple[int, int]]], dimensions: tuple[int, int], looping: bool = False):
+        self.dimensions = dimensions
+        self.looping = looping
+        columns = {x: i for i, x in enumerate(sorted({job[0].x for job in jobs}))}
+        rows = {y: i for i, y in enumerate(sorted({job[0].y for job in jobs}))}
+        ordered = sorted(jobs, key=lambda job: (columns[job[0].x] % 2, rows[job[0].y] % 2, job[0].y, job[0].x))
+        self.waves: list[list[tuple[Position, tuple[int, int]]]] = []
+        for job in ordered:
+            for wave in self.waves:
+                if not any(jobs_conflict(job, other, dimensions, looping) for other in wave):
+                    wave.append(job)
+                    break
+            else:
+                self.waves.append([job])
+
+    def __len__(self):
+        return len(self.waves)
+
+    def run(self, run_job, pool=None, timings: list[tuple[int, float]] | None = None):
+        """Calls run_job(job) for every job, see run_waves."""
+        return run_waves([(self, run_job)], pool, timings)[0]
+
+
+def run_task(task):
+    return task()
+
+
+def run_waves(schedules: list[tuple[WaveScheduler, object]], pool=None, timings: list[tuple[int, float]] | None = None):
+    """
+        Runs the jobs of several (scheduler, run_job) pairs, one wave after
+        another. Wave n of every scheduler goes out together.
+        With a multiprocessing pool, each wave is spread over it and
+        finishes before the next one starts.
+        If timings is given, (number of jobs, seconds) is appended to it
+        for each wave. While instrumentation is on, the metrics each job
+        records, wherever it ran, are merged into the active ones.
+        Returns a list of (job, what run_job returned) for each schedule.
+    """
+    outcomes = [[] for _ in schedules]
+    for wave in range(max((len(scheduler) for scheduler, _ in schedules), default=0)):
+        start = time.perf_counter()
+        owners = [(i, job)
+                  for i, (scheduler, _) in enumerate(schedules) if wave < len(scheduler)
+                  for job in scheduler.waves[wave]]
+        tasks = [functools.partial(schedules[i][1], job) for i, job in owners]
+        if instrumentation.active is not None:
+            # Each task records into its own metrics, which come back with it
+            wrapped = instrumentation.instrument_tasks(tasks, sent=pool is not None)
+            if pool is None:
+                results = [instrumentation.instrumented_task(*task) for task in wrapped]
+            else:
+                results = pool.starmap(instrumentation.instrumented_task, wrapped)
+            results = instrumentation.gather(results)
+        elif pool is None:
+            results = [task() for task in tasks]
+        else:
+            results = pool.map(run_task, tasks)
+        for (i, job), result in zip(owners, results):
+            outcomes[i].append((job, result))
+        if timings is not None:
+            timings.append((len(tasks), time.perf_counter() - start))
+    return outcomes
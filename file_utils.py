@@ -0,0 +1,19 @@
+import os
+
+
+def atomic_write(path: str, write):
+    """
+        Calls write with a temporary path next to path, then moves what it
+        wrote to path, so a reader never sees half a file. If write fails,
+        the temporary file is removed and path is left as it was.
+    """
+    temporary = path + ".tmp"
+    try:
+        write(temporary)
+        os.replace(temporary, path)
+    except BaseException:
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
+        raise
@@ -0,0 +1,137 @@
+import math
+import random
+from tileset import Tileset
+
+
+class IndexedHeap:
+    """
+        Binary min-heap of (key, item) that also tracks where each item sits,
+        so an item's key can be changed or the item removed in O(log n).
+    """
+    def __init__(self):
+        self.heap: list[tuple[float, int]] = []
+        self.positions: dict[int, int] = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, item: int):
+        return item in self.positions
+
+    def push(self, item: int, key: float):
+        """Adds item, or changes its key if it is already in the heap."""
+        position = self.positions.get(item)
+        if position is None:
+            self.heap.append((key, item))
+            self.positions[item] = len(self.heap) - 1
+            self._sift_up(len(self.heap) - 1)
+            return
+        old_key = self.heap[position][0]
+        self.heap[position] = (key, item)
+        if key < old_key:
+            self._sift_up(position)
+        else:
+            self._sift_down(position)
+
+    def pop(self):
+        """Removes and returns the item with the smallest key."""
+        item = self.heap[0][1]
+        self.remove(item)
+        return item
+
+    def remove(self, item: int):
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        last = self.heap.pop()
+        if position == len(self.heap):
+            return
+        self.heap[position] = last
+        self.positions[last[1]] = position
+        self._sift_up(position)
+        self._sift_down(self.positions[last[1]])
+
+    def _sift_up(self, position: int):
+        heap = self.heap
+        entry = heap[position]
+        while position > 0:
+            parent = (position - 1) >> 1
+            if heap[parent][0] <= entry[0]:
+                break
+            heap[position] = heap[parent]
+            self.positions[heap[position][1]] = position
+            position = parent
+        heap[position] = entry
+        self.positions[entry[1]] = position
+
+    def _sift_down(self, position: int):
+        heap = self.heap
+        size = len(heap)
+        entry = heap[position]
+        while True:
+            child = 2 * position + 1
+            if child >= size:
+                break
+            if child + 1 < size and heap[child + 1][0] < heap[child][0]:
+                child += 1
+            if entry[0] <= heap[child][0]:
+                break
+            heap[position] = heap[child]
+            self.positions[heap[position][1]] = position
+            position = child
+        heap[position] = entry
+        self.positions[entry[1]] = position
+
+
+class Frontier:
+    """
+        The undecided cells of a map, ordered by how constrained they are.
+        heuristic is "domain_size" (number of options left) or "entropy"
+        (Shannon entropy of the options, using weights if given, or the
+        tileset's weights otherwise).
+        Ties are broken randomly so generation doesn't drift in one direction.
+        If cells is given, only the indices marked in it are tracked, so
+        propagating past the cells being generated doesn't add others.
+    """
+    def __init__(self, tileset: Tileset, heuristic: str = "entropy", weights: dict[str, float] | None = None, rng=random, cells: bytearray | None = None):
+        if heuristic not in {"domain_size", "entropy"}:
+            raise ValueError(f"Unknown heuristic {heuristic}")
+        self.tileset = tileset
+        self.heuristic = heuristic
+        self.weights = weights if weights is not None else tileset.weights
+        self.rng = rng
+        self.cells = cells
+        self.heap = IndexedHeap()
+        self.keys: dict[int, float] = {}
+
+    def __len__(self):
+        return len(self.heap)
+
+    def key(self, mask: int):
+        key = self.keys.get(mask)
+        if key is None:
+            if self.heuristic == "domain_size":
+                key = float(len(self.tileset.bit_choices(mask)))
+            else:
+                tile_weights = [self.weights.get(self.tileset.decode(bit), 1.0)
+                                for bit in self.tileset.bit_choices(mask)]
+                total = sum(tile_weights)
+                if total > 0:
+                    key = math.log(total) - sum(w * math.log(w) for w in tile_weights if w > 0) / total
+                else:
+                    # Only zero weights are picked from uniformly (see Tileset.choose)
+                    key = math.log(len(tile_weights))
+            self.keys[mask] = key
+        return key
+
+    def update(self, index: int, mask: int):
+        """Called whenever a cell's domain changes."""
+        if self.cells is not None and not self.cells[index]:
+            return
+        if mask & (mask - 1):
+            self.heap.push(index, self.key(mask) + self.rng.random() * 1e-6)
+        else:
+            self.heap.remove(index)
+
+    def pop(self):
+        return self.heap.pop()
@@ -0,0 +1,93 @@
+"""
+    Generates a map without opening a window, and writes it to a file or
+    stdout. Only the generator itself is imported up front; numpy and the
+    map file format are only loaded for the outputs that need them.
+
+        python generate.py 256 256 --chunk 32 --workers 4 --seed 7 -o world.png
+        python generate.py 80 40 --format ansi
+"""
+import time
+
+STARTED = time.perf_counter()
+
+import argparse
+import os
+import sys
+from tileset import Tileset
+from wavefunction_collapse import ChunkedGenerator
+
+IMPORTED = time.perf_counter()
+
+FORMATS = {"text", "ansi", "map", "png"}
+# Formats picked from the output file's extension when none is given
+EXTENSIONS = {".png": "png", ".map": "map", ".txt": "text"}
+
+
+def write_output(map, output, format: str):
+    """Writes map to output (a path, or "-" for stdout) in format."""
+    binary = format in {"map", "png"}
+    if output == "-":
+        stream = sys.stdout.buffer if binary else sys.stdout
+        write_stream(map, stream, format)
+        stream.flush()
+        return
+    with open(output, "wb" if binary else "w") as stream:
+        write_stream(map, stream, format)
+
+
+def write_stream(map, stream, format: str):
+    if format == "text":
+        # Written a row at a time, so a big map is never one big string
+        map.render(stream, color=False)
+        stream.write("\n")
+    elif format == "ansi":
+        map.render(stream)
+        stream.write("\n")
+    elif format == "map":
+        from map_file import write_map
+        write_map(map, stream, compression="zlib")
+    elif format == "png":
+        from image_render import png_bytes, rasterize
+        stream.write(png_bytes(rasterize(map)))
+    else:
+        raise ValueError(f"Unknown format {format}")
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description="Generates a map without a display.")
+    parser.add_argument("width", type=int)
+    parser.add_argument("height", type=int)
+    parser.add_argument("--chunk", type=int, nargs="+", default=[32], help="chunk size, or chunk width and height")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--engine", choices=["scalar", "numpy"], default="scalar")
+    parser.add_argument("--selection", choices=["scanline", "domain_size", "entropy"], default="scanline", help="how the scalar engine picks the next cell")
+    parser.add_argument("--looping", action="store_true")
+    parser.add_argument("--tileset", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "default_tileset.json"))
+    parser.add_argument("--format", choices=sorted(FORMATS), default=None, help="by default from the output's extension, or text")
+    parser.add_argument("-o", "--output", default="-", help="file to write, - for stdout")
+    parser.add_argument("--timings", action="store_true", help="print how long importing, generating and writing took to stderr")
+    options = parser.parse_args(arguments)
+
+    format = options.format
+    if format is None:
+        format = EXTENSIONS.get(os.path.splitext(options.output)[1], "text")
+    chunk = options.chunk * 2 if len(options.chunk) == 1 else options.chunk[:2]
+    dimensions = (options.width, options.height)
+    chunk_dimensions = (min(chunk[0], options.width), min(chunk[1], options.height))
+
+    start = time.perf_counter()
+    tileset = Tileset.parse_json(options.tileset)
+    with ChunkedGenerator(tileset, options.workers, options.engine, options.selection) as generator:
+        new_map = generator.generate(dimensions, chunk_dimensions, options.looping, options.seed)
+    generated = time.perf_counter()
+    write_output(new_map, options.output, format)
+    written = time.perf_counter()
+    if options.timings:
+        print(f"imports {(IMPORTED - STARTED) * 1000:.1f}ms, generation {generated - start:.3f}s, "
+              f"output {written - generated:.3f}s", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 import random
+import numpy as np
 
 from position import Direction, Position
 
@@ -8,70 +9,265 @@ class GoalManager:
         self.player = player  # Store the player object
         self.keys = []
         self.goal_position = None
+        self.walkability = WalkabilityIndex(map)
         self.place_keys()
         self.place_goal()
 
     def place_keys(self):
         num_keys = random.randint(1, 5)
         for _ in range(num_keys):
-            while True:
-                x = random.randint(0, self.map.dimensions[0] - 1)
-                y = random.randint(0, self.map.dimensions[1] - 1)
-                pos = Position(x, y)
-                if self.map.get_tile(pos) not in {"O", "U"} and self.is_reachable(pos):
-                    self.keys.append((pos))
-                    self.map.set_tile(pos, "U")  # "U" represents a button
-                    break
+            pos = self.random_reachable()
+            if pos is None:
+                break  # Every reachable cell has something on it already
+            self.keys.append((pos))
+            self.set_tile(pos, "U")  # "U" represents a button
 
     def place_goal(self):
-        while True:
-            x = random.randint(0, self.map.dimensions[0] - 1)
-            y = random.randint(0, self.map.dimensions[1] - 1)
-            pos = Position(x, y)
-            if self.map.get_tile(pos) not in {"O", "U"} and self.is_reachable(pos):
-                self.goal_position = (pos)
-                self.map.set_tile(pos, "R")  # "R" represents a red goal (locked)
-                break
+        pos = self.random_reachable()
+        if pos is None:
+            raise ValueError("There is nowhere reachable to put the goal")
+        self.goal_position = (pos)
+        self.set_tile(pos, "R")  # "R" represents a red goal (locked)
+
+    def set_tile(self, pos: Position, tile: str):
+        self.map.set_tile(pos, tile)
+        self.walkability.update(pos)
 
     def collect_key(self, pos: Position):
         if (pos) in self.keys:
             self.keys.remove(pos)
-            self.map.set_tile(pos, "C")  # "C" represents a pressed button
+            self.set_tile(pos, "C")  # "C" represents a pressed button
             if not self.keys:  # All buttons pressed
                 g_pos = self.goal_position
-                self.map.set_tile(g_pos, "G")  # "G" represents a green goal (unlocked)
+                self.set_tile(g_pos, "G")  # "G" represents a green goal (unlocked)
 
     def is_goal_reachable(self):
         return not self.keys  # Goal is reachable only when all keys are collected
 
     def is_reachable(self, target_pos: Position):
-        visited = set()
-        stack = [self.player.pos]
-
-        while stack:
-            pos = stack.pop()
-            if pos == target_pos:
-                return True
-
-            if pos in visited:
-                continue
-
-            visited.add(pos)
-
-            for direction in Direction.all_cardinal():
-                new_pos = pos + direction.get_tuple()
-                if 0 <= new_pos.x < self.map.dimensions[0] and 0 <= new_pos.y < self.map.dimensions[1]:
-                    tile = self.map.get_tile(new_pos)
-                    if tile not in {"U", "R"} and self.map.tileset.is_walkable(tile):
-                        stack.append(new_pos)
+        if target_pos == self.player.pos:
+            return True
+        return self.walkability.labels[self.map.index(target_pos)] in self.walkability.reachable_from(self.player.pos)
 
-        return False
+    def random_reachable(self):
+        """A cell the player can walk to, chosen uniformly, or None if there isn't one."""
+        return self.walkability.sample(self.walkability.reachable_from(self.player.pos))
 
     def restart_game(self, map, player):
         self.map = map
         self.player = player
         self.keys = []
         self.goal_position = None
+        self.walkability = WalkabilityIndex(map)
         self.place_keys()
         self.place_goal()
         print("Game has been reset with new keys and goal.")
+
+
+class WalkabilityIndex:
+    """
+        Labels every cell the player can walk on with the connected region
+        it belongs to, so whether one cell can be reached from another is a
+        lookup, and a random reachable cell can be drawn without retrying.
+        Buttons and locked goals ("U", "R") block the way like unwalkable
+        tiles do. update() fixes the labels up when one cell changes.
+    """
+    BLOCKING = {"U", "R"}
+
+    def __init__(self, map):
+        self.map = map
+        # Region of each cell, -1 for cells that can't be walked on
+        self.labels: list[int] = []
+        # The cells of each region, and where each cell is in its list
+        self.regions: dict[int, list[int]] = {}
+        self.slots: list[int] = []
+        self.next_label = 0
+        self.code_passable = {}
+        self.label_regions()
+
+    def label_regions(self):
+        """
+            Labels the whole map in one pass. Each row is cut into runs of
+            passable cells, runs that touch in the next row down are joined
+            with union-find, and every run's cells get its root's label.
+        """
+        width, height = self.map.dimensions
+        codes = self.map.as_numpy()
+        present = np.unique(codes)
+        passable = np.array([self.passable_code(int(code)) for code in present], dtype=bool)
+        open_cells = passable[np.searchsorted(present, codes)]
+        edges = np.diff(np.pad(open_cells, ((0, 0), (1, 1))).astype(np.int8), axis=1)
+        rows, starts = np.nonzero(edges == 1)
+        ends = np.nonzero(edges == -1)[1]
+        row_first = np.searchsorted(rows, np.arange(height + 1)).tolist()
+        starts_list = starts.tolist()
+        ends_list = ends.tolist()
+        parent = list(range(len(starts_list)))
+
+        def find(run):
+            while parent[run] != run:
+                parent[run] = parent[parent[run]]
+                run = parent[run]
+            return run
+
+        def union(a, b):
+            a = find(a)
+            b = find(b)
+            if a != b:
+                parent[max(a, b)] = min(a, b)
+
+        for y in range(height):
+            first, last = row_first[y], row_first[y + 1]
+            if self.map.looping and last - first > 1 and starts_list[first] == 0 and ends_list[last - 1] == width:
+                union(first, last - 1)  # The row wraps around
+            if y == height - 1 and not self.map.looping:
+                break
+            # Runs of this row and the next that overlap, found by walking both rows at once
+            below = (y + 1) % height
+            i, j = first, row_first[below]
+            j_last = row_first[below + 1]
+            while i < last and j < j_last:
+                if starts_list[i] < ends_list[j] and starts_list[j] < ends_list[i]:
+                    union(i, j)
+                if ends_list[i] < ends_list[j]:
+                    i += 1
+                else:
+                    j += 1
+        roots = np.array([find(run) for run in range(len(parent))], dtype=np.int64)
+        run_labels = np.unique(roots, return_inverse=True)[1].reshape(-1)
+        labels = np.full(width * height, -1, dtype=np.int64)
+        labels[open_cells.reshape(-1)] = np.repeat(run_labels, ends - starts)
+        # Each region's cells, in index order, and each cell's place among them
+        cells = np.nonzero(labels >= 0)[0]
+        order = cells[np.argsort(labels[cells], kind="stable")]
+        counts = np.bincount(labels[cells])
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        slots = np.zeros(width * height, dtype=np.int64)
+        slots[order] = np.arange(len(order)) - np.repeat(offsets[:-1], counts)
+        self.labels = labels.tolist()
+        self.slots = slots.tolist()
+        order_list = order.tolist()
+        self.regions = {label: order_list[offsets[label]:offsets[label + 1]] for label in range(len(counts))}
+        self.next_label = len(counts)
+
+    def passable(self, index: int):
+        return self.passable_code(self.map.original_tiles[index])
+
+    def passable_code(self, code: int):
+        passable = self.code_passable.get(code)
+        if passable is None:
+            tile = self.map.tileset.decode(code)
+            passable = (not isinstance(tile, set) and tile not in WalkabilityIndex.BLOCKING
+                        and self.map.tileset.is_walkable(tile))
+            self.code_passable[code] = passable
+        return passable
+
+    def neighbours(self, index: int):
+        width, height = self.map.dimensions
+        x = index % width
+        y = index // width
+        for direction in Direction.all_cardinal():
+            dx, dy = direction.get_tuple()
+            nx = x + dx
+            ny = y + dy
+            if self.map.looping:
+                yield (ny % height) * width + nx % width
+            elif 0 <= nx < width and 0 <= ny < height:
+                yield ny * width + nx
+
+    def fill(self, start: int, unlabelled: int):
+        """Gives start and every cell labelled unlabelled joined to it a new region."""
+        label = self.next_label
+        self.next_label += 1
+        self.regions[label] = []
+        self.add(start, label)
+        stack = [start]
+        while stack:
+            index = stack.pop()
+            for neighbour in self.neighbours(index):
+                if self.labels[neighbour] == unlabelled:
+                    self.add(neighbour, label)
+                    stack.append(neighbour)
+
+    def add(self, index: int, label: int):
+        region = self.regions[label]
+        self.labels[index] = label
+        self.slots[index] = len(region)
+        region.append(index)
+
+    def remove(self, index: int):
+        region = self.regions[self.labels[index]]
+        # The last cell takes its place, so removing doesn't shift the list
+        last = region.pop()
+        if last != index:
+            region[self.slots[index]] = last
+            self.slots[last] = self.slots[index]
+        self.labels[index] = -1
+
+    def update(self, pos: Position):
+        """Call after the tile at pos changes."""
+        index = self.map.index(pos)
+        self.code_passable.clear()  # The tileset may have gained tiles
+        passable = self.passable(index)
+        if passable == (self.labels[index] != -1):
+            return
+        if passable:
+            self.open_cell(index)
+        else:
+            self.close_cell(index)
+
+    def open_cell(self, index: int):
+        """Joins index, and the regions around it, into one region."""
+        labels = {self.labels[neighbour] for neighbour in self.neighbours(index)} - {-1}
+        if not labels:
+            self.regions[self.next_label] = []
+            self.add(index, self.next_label)
+            self.next_label += 1
+            return
+        # The smaller regions are relabelled into the biggest
+        biggest = max(labels, key=lambda label: len(self.regions[label]))
+        self.add(index, biggest)
+        for label in labels - {biggest}:
+            for cell in self.regions.pop(label):
+                self.add(cell, biggest)
+
+    def close_cell(self, index: int):
+        """Takes index out of its region, which may split it in several."""
+        label = self.labels[index]
+        self.remove(index)
+        joined = [neighbour for neighbour in self.neighbours(index) if self.labels[neighbour] == label]
+        if not self.regions[label]:
+            del self.regions[label]
+        # A cell with one neighbour in the region can't have been holding it together
+        if len(joined) <= 1:
+            return
+        unlabelled = -2
+        for cell in self.regions.pop(label):
+            self.labels[cell] = unlabelled
+        for neighbour in joined:
+            if self.labels[neighbour] == unlabelled:
+                self.fill(neighbour, unlabelled)
+
+    def reachable_from(self, pos: Position):
+        """
+            The regions a player at pos can walk into: its own, or if pos
+            itself can't be walked on, those of the cells around it.
+        """
+        index = self.map.index(pos)
+        if self.labels[index] != -1:
+            return {self.labels[index]}
+        return {self.labels[neighbour] for neighbour in self.neighbours(index)} - {-1}
+
+    def sample(self, labels: set[int], rng=random):
+        """A uniformly random cell of the given regions, or None if they are empty."""
+        labels = sorted(labels)
+        total = sum(len(self.regions[label]) for label in labels)
+        if not total:
+            return None
+        pick = rng.randrange(total)
+        for label in labels:
+            region = self.regions[label]
+            if pick < len(region):
+                width = self.map.dimensions[0]
+                return Position(region[pick] % width, region[pick] // width)
+            pick -= len(region)
@@ -0,0 +1,105 @@
+import struct
+import zlib
+import numpy as np
+from position import Position
+from map import Map
+
+# Tiles the game puts on the map, which tilesets have no colours for
+MARKER_COLORS = {
+    # "B": "#D2B48C",  # Tan (beach color)
+    # "L": "#556B2F",  # Dark Olive Green (land color)
+    # "O": "#4682B4",  # Steel Blue (ocean color)
+    "P": "#FF4500",  # Orange Red (Player color)
+    "U": "#4B0082",  # Indigo (Button color)
+    "C": "#9500ff",  # Brighter Purple (Pressed button color)
+    "R": "#8B0000",  # Dark Red (Locked goal color)
+    "G": "#dcaf09"   # Gold (Unlocked goal color)
+}
+DEFAULT_COLOR = "#ffffff"
+# Codes up to this get a lookup table indexed by the code itself
+DIRECT_LOOKUP_SIZE = 1 << 20
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def hex_rgb(color: str | None):
+    """(r, g, b) of a "#rrggbb" colour. Anything else (names, ANSI escapes) is white."""
+    if color is None or not color.startswith("#") or len(color) != 7:
+        color = DEFAULT_COLOR
+    return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
+
+
+def code_color(map: Map, code: int, colors: dict[str, str] | None = None):
+    """The "#rrggbb" colour a cell code is drawn in. Undecided cells are white."""
+    tile = map.tileset.decode(code)
+    if isinstance(tile, set):
+        return DEFAULT_COLOR
+    color = map.tileset.get_color(tile)
+    if color is None:
+        color = (colors if colors is not None else MARKER_COLORS).get(tile, DEFAULT_COLOR)
+    return color
+
+
+def rasterize(map: Map, pos: Position | None = None, dimensions: tuple[int, int] | None = None, zoom: int = 1, visual: bool = True, colors: dict[str, str] | None = None):
+    """
+        Draws the map (or the dimensions sized window at pos) as a
+        (height * zoom, width * zoom, 3) array of RGB pixels, zoom pixels
+        to a cell.
+        Each cell code present is coloured once, and the whole grid goes
+        through the resulting lookup table in one step.
+        visual draws the visual overlay (the player...) on top.
+    """
+    if pos is None:
+        pos = Position(0, 0)
+    if dimensions is None:
+        dimensions = map.dimensions
+    if pos == (0, 0) and tuple(dimensions) == tuple(map.dimensions):
+        codes = map.as_numpy()
+    else:
+        codes = map.get_patch(pos, dimensions).as_numpy()
+    if codes.size and int(codes.max()) < DIRECT_LOOKUP_SIZE:
+        present = np.flatnonzero(np.bincount(codes.ravel()))
+        table = np.zeros((int(present[-1]) + 1, 3), dtype=np.uint8)
+        table[present] = [hex_rgb(code_color(map, int(code), colors)) for code in present]
+        pixels = table[codes]
+    else:
+        present, inverse = np.unique(codes, return_inverse=True)
+        table = np.array([hex_rgb(code_color(map, int(code), colors)) for code in present], dtype=np.uint8).reshape(-1, 3)
+        pixels = table[inverse.reshape(codes.shape)]
+    if visual and map.visual_overlay:
+        width, height = map.dimensions
+        for index, code in map.visual_overlay.items():
+            x = (index % width - pos.x) % width
+            y = (index // width - pos.y) % height
+            if x < dimensions[0] and y < dimensions[1]:
+                pixels[y, x] = hex_rgb(code_color(map, code, colors))
+    if zoom > 1:
+        pixels = pixels.repeat(zoom, axis=0).repeat(zoom, axis=1)
+    return pixels
+
+
+def ppm_bytes(pixels: np.ndarray):
+    """pixels as a binary PPM, which tkinter's PhotoImage reads without any other library."""
+    height, width, _ = pixels.shape
+    return b"P6 %d %d 255\n" % (width, height) + np.ascontiguousarray(pixels, dtype=np.uint8).tobytes()
+
+
+def png_bytes(pixels: np.ndarray, level: int = 6):
+    """pixels as an 8 bit RGB PNG, written with nothing but zlib."""
+    height, width, _ = pixels.shape
+    # Every row starts with its filter type, 0 for none
+    rows = np.zeros((height, width * 3 + 1), dtype=np.uint8)
+    rows[:, 1:] = pixels.reshape(height, width * 3)
+    return (PNG_SIGNATURE
+            + png_chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + png_chunk(b"IDAT", zlib.compress(rows.tobytes(), level))
+            + png_chunk(b"IEND", b""))
+
+
+def png_chunk(kind: bytes, data: bytes):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+
+def save_png(map: Map, path: str, zoom: int = 1, visual: bool = True, colors: dict[str, str] | None = None):
+    """Writes the whole map to path as a PNG. Needs no display."""
+    with open(path, "wb") as file:
+        file.write(png_bytes(rasterize(map, zoom=zoom, visual=visual, colors=colors)))
@@ -0,0 +1,130 @@
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+# The Metrics being recorded into, or None when instrumentation is off.
+# Hot paths check this once per call, so being off costs next to nothing.
+active = None
+
+
+class Metrics:
+    """
+        Counters and timers recorded while generating.
+        Counters are plain totals (collapses, propagation steps, bytes
+        copied...). Timers keep the count, total and longest of the
+        durations added to them. Metrics recorded in worker processes are
+        merged in both into the totals and under the worker's pid.
+    """
+    def __init__(self):
+        self.counters: Counter[str] = Counter()
+        self.timers: dict[str, list[float]] = {}
+        self.workers: dict[int, Metrics] = {}
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] += amount
+
+    def add_time(self, name: str, seconds: float):
+        timer = self.timers.get(name)
+        if timer is None:
+            self.timers[name] = [1, seconds, seconds]
+        else:
+            timer[0] += 1
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds)
+
+    def merge(self, other, worker: int | None = None):
+        """Adds other's counts and times to these, and to worker's if given."""
+        self.counters.update(other.counters)
+        for name, (count, total, longest) in other.timers.items():
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += count
+            timer[1] += total
+            timer[2] = max(timer[2], longest)
+        if worker is not None:
+            self.workers.setdefault(worker, Metrics()).merge(other)
+
+    def report(self):
+        """Everything recorded, as plain dicts and numbers that json can write."""
+        return {
+            "counters": dict(self.counters),
+            "timers": {name: {"count": count, "total": total, "max": longest, "mean": total / count}
+                       for name, (count, total, longest) in self.timers.items()},
+            "workers": {str(pid): worker.report() for pid, worker in self.workers.items()},
+        }
+
+
+def enable(metrics: Metrics | None = None):
+    """Starts recording into metrics (a new Metrics by default), and returns it."""
+    global active
+    active = metrics if metrics is not None else Metrics()
+    return active
+
+
+def disable():
+    """Stops recording, and returns what was recorded."""
+    global active
+    metrics = active
+    active = None
+    return metrics
+
+
+@contextmanager
+def collect(callback=None):
+    """
+        Records everything inside the with block into the Metrics it
+        yields. callback, if given, is called with the report at the end.
+    """
+    previous = active
+    metrics = enable()
+    try:
+        yield metrics
+    finally:
+        if previous is not None:
+            enable(previous)
+        else:
+            disable()
+        if callback is not None:
+            callback(metrics.report())
+
+
+def instrumented_task(task, submitted: float):
+    """
+        Runs task with its own Metrics, in whichever process it lands in,
+        and sends them back with the result. submitted is when the task was
+        handed to the pool, so the time it spent queued can be told apart
+        from the time it ran. (perf_counter is the same clock in every
+        process on one machine.)
+    """
+    global active
+    start = time.perf_counter()
+    previous = active
+    metrics = active = Metrics()
+    metrics.add_time("queue_wait", start - submitted)
+    try:
+        result = task()
+    finally:
+        metrics.add_time("job", time.perf_counter() - start)
+        active = previous
+    return result, os.getpid(), metrics
+
+
+def instrument_tasks(tasks: list, sent: bool = True):
+    """
+        Wraps tasks for instrumented_task. If they are being sent to other
+        processes, the bytes that takes are counted.
+    """
+    submitted = time.perf_counter()
+    if sent:
+        import pickle
+        active.count("ipc_task_bytes", sum(len(pickle.dumps(task)) for task in tasks))
+    return [(task, submitted) for task in tasks]
+
+
+def gather(results: list):
+    """Merges the Metrics coming back from instrumented_task, returning the plain results."""
+    plain = []
+    for result, worker, metrics in results:
+        active.merge(metrics, worker)
+        plain.append(result)
+    return plain
@@ -0,0 +1,98 @@
+import random
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from recovery import Contradiction
+from wavefunction_collapse import ChunkedGenerator
+
+# Levels stop growing once they are this big each way
+MAX_LEVEL_SIZE = 32
+
+
+def grow_dimensions(dimensions: tuple[int, int]):
+    """The size of the level after one of dimensions: a few cells bigger each way, up to MAX_LEVEL_SIZE."""
+    return (min(dimensions[0] + random.randint(1, 5), MAX_LEVEL_SIZE),
+            min(dimensions[1] + random.randint(1, 5), MAX_LEVEL_SIZE))
+
+
+def level_chunk_dimensions(dimensions: tuple[int, int]):
+    return (min(dimensions[0] // 4, 32), min(dimensions[1] // 4, 32))
+
+
+class LevelQueue:
+    """
+        Levels generated ahead of time on a background thread, so going to
+        the next one doesn't wait for generation.
+        Each level's size follows from the one before (see
+        grow_dimensions), so the next levels can be started as soon as the
+        current one is. Up to depth levels are kept ready or in progress.
+        Call close when done with it.
+    """
+    def __init__(self, generator: ChunkedGenerator, dimensions: tuple[int, int], depth: int = 1):
+        self.generator = generator
+        self.depth = depth
+        # Size of the last level queued, or of the one being played
+        self.last_dimensions = dimensions
+        # (dimensions, future map) of each level, in the order they are played
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="levels")
+        self.ready = 0
+        self.waited = 0
+        self.generated_here = 0
+        self.fill()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Drops the queued levels. One already being generated is left to finish on its own."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.pending.clear()
+
+    def fill(self):
+        while len(self.pending) < self.depth:
+            self.last_dimensions = grow_dimensions(self.last_dimensions)
+            self.pending.append((self.last_dimensions, self.executor.submit(self.generate, self.last_dimensions)))
+
+    def generate(self, dimensions: tuple[int, int]):
+        return self.generator.generate(dimensions, level_chunk_dimensions(dimensions))
+
+    def take(self):
+        """
+            The next level's map, and starts on the one after.
+            A level that is ready is handed over straight away, and one
+            being generated is waited for, as starting again would only
+            compete with it. If it never started, or generating it failed,
+            it is generated here instead.
+        """
+        if not self.pending:
+            # Nothing is queued with a depth of 0
+            self.last_dimensions = grow_dimensions(self.last_dimensions)
+            self.generated_here += 1
+            return self.generate(self.last_dimensions)
+        dimensions, future = self.pending.popleft()
+        if future.cancel():
+            self.generated_here += 1
+            new_map = self.generate(dimensions)
+        else:
+            if future.done():
+                self.ready += 1
+            else:
+                self.waited += 1
+            try:
+                new_map = future.result()
+            except Contradiction:
+                self.generated_here += 1
+                new_map = self.generate(dimensions)
+        self.fill()
+        return new_map
+
+    def stats(self):
+        return {
+            "ready": self.ready,
+            "waited": self.waited,
+            "generated_here": self.generated_here,
+            "queued": len(self.pending),
+        }
@@ -1,12 +1,11 @@
 from position import Direction
 from map import Map
 from player import Player  # Import the Player class
-from pynput import keyboard  # Import keyboard listener
-import colorama
 from tileset import Tileset
 from mapVisual import MapVisualizer
+from levels import LevelQueue, level_chunk_dimensions
 import tileset
-from wavefunction_collapse import map_generation, map_generation_chunked
+from wavefunction_collapse import map_generation, map_generation_chunked, ChunkedGenerator
 
 
 def main():
@@ -21,14 +20,18 @@ def main():
     # tileset.add_rule({"B", "O"}, Direction.all_cardinal(), {"B", "O"})
     tileset = Tileset.parse_json("default_tileset.json")
     dimensions = (10,10)
-    chunk_dimensions = (min(dimensions[0] // 4, 32), min(dimensions[1] // 4, 32))
+    chunk_dimensions = level_chunk_dimensions(dimensions)
     # map = Map(dimensions, tileset)
     # map_generation(map)
-    map = map_generation_chunked(tileset, dimensions, chunk_dimensions, num_threads=8)
+    # The generator's workers are reused for every level after this one
+    generator = ChunkedGenerator(tileset, num_threads=8)
+    map = generator.generate(dimensions, chunk_dimensions)
     player = Player(dimensions)  # Initialize player with randomized position
     while map.get_tile(player.pos) == "O":
         player = Player(dimensions)  # Reinitialize player until not on 'O'
     player.update_map(map)  # Place player on the map
+    # The next level is generated in the background while this one is played
+    levels = LevelQueue(generator, dimensions)
 
     print(
             "\nWelcome to the WFC World Generator Game!\n"
@@ -39,7 +42,7 @@ def main():
             "Good luck!\n"
         )
 
-    visualizer = MapVisualizer(map, player)  # Initialize the visualizer
+    visualizer = MapVisualizer(map, player, generator, levels=levels)  # Initialize the visualizer
 
     def on_keypress(event):
         player.handle_keypress(event, map, visualizer)  # Delegate keypress handling to Player
@@ -51,6 +54,8 @@ def main():
     visualizer.root.bind("q", lambda event: on_keypress(event))  # Bind 'q' key to quit
 
     visualizer.run()  # Run the tkinter visualization
+    levels.close()
+    generator.close()
 
 
 if __name__ == "__main__":
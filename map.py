@@ -1,65 +1,136 @@
-import colorama
+import itertools
+from array import array
+import instrumentation
 from position import Position, Direction
 from tileset import Tileset
-import copy
+
+# colorama.Style.RESET_ALL, without importing colorama just for it
+RESET = "\x1b[0m"
+
 
 class Map:
+    __slots__ = ("tileset", "dimensions", "original_tiles", "visual_overlay", "looping", "changed_cells")
+
     def __init__(self):
         self.tileset: Tileset
         self.dimensions: tuple[int, int]
-        self.visual_tiles: list[str] = []
-        self.original_tiles: list[set[str] | str] = []
+        # Tile bitmasks (see Tileset.encode) in row-major order, in the
+        # smallest typed array that holds them. A memoryview of a mapped
+        # file works too (see map_file).
+        self.original_tiles: array | memoryview = array("B")
+        # Cells drawn differently from what they hold (the player...), by index
+        self.visual_overlay: dict[int, int] = {}
         self.looping: bool = False
+        # Indices of cells changed through set_domain and the visual tile
+        # methods, while tracking (see track_changes)
+        self.changed_cells: set[int] | None = None
 
     @staticmethod
     def new(dimensions: tuple[int, int], tileset: Tileset, looping: bool = False):
         new_map = Map()
         new_map.dimensions = dimensions
-        num_tiles = dimensions[0] * dimensions[1]
-        new_map.visual_tiles = ["e" for _ in range(num_tiles)]
-        new_map.original_tiles = [tileset.tiles for _ in range(num_tiles)]   # Store original tiles
         new_map.tileset = tileset
         new_map.looping = looping
+        new_map.set_tileset(tileset)
         return new_map
 
     def set_tileset(self, tileset: Tileset):
         num_tiles = self.dimensions[0] * self.dimensions[1]
-        self.visual_tiles = ["e" for _ in range(num_tiles)]
-        self.original_tiles = [tileset.tiles for _ in range(num_tiles)]   # Store original tiles
+        self.original_tiles = array(tileset.code_typecode(), [tileset.all_mask]) * num_tiles
+        self.visual_overlay = {}
         self.tileset = tileset
 
     def self_from_map(self, map):
         self.dimensions = map.dimensions
         self.set_tileset(map.tileset)
         self.original_tiles = map.original_tiles
-        self.visual_tiles = map.visual_tiles
+        self.visual_overlay = map.visual_overlay
 
-    def get_tile(self, pos: Position):
+    def index(self, pos: Position):
         x = pos.x
         y = pos.y
         if self.looping:
             x = x % self.dimensions[0]
             y = y % self.dimensions[1]
-        return self.original_tiles[y * self.dimensions[0] + x]
+        return y * self.dimensions[0] + x
+
+    def get_domain(self, pos: Position):
+        return self.original_tiles[self.index(pos)]
+
+    def set_domain(self, pos: Position, mask: int):
+        index = self.index(pos)
+        self.set_domain_index(index, mask)
+        if self.changed_cells is not None:
+            self.changed_cells.add(index)
+
+    def track_changes(self):
+        """Starts recording which cells change, for redrawing just those."""
+        self.changed_cells = set()
+
+    def take_changes(self):
+        """The cells changed since the last call, or since tracking started."""
+        changed = self.changed_cells
+        self.changed_cells = set() if changed is not None else None
+        return changed if changed is not None else set()
+
+    def set_domain_index(self, index: int, mask: int):
+        try:
+            self.original_tiles[index] = mask
+        except (OverflowError, ValueError):
+            # A tile added since the array was made needs a wider code
+            self.original_tiles = array(self.tileset.code_typecode(), self.original_tiles)
+            self.original_tiles[index] = mask
+        if self.visual_overlay:
+            self.visual_overlay.pop(index, None)
+
+    def load_domains(self, domains):
+        """Replaces every cell at once, in row-major order."""
+        self.original_tiles = array(self.tileset.code_typecode(), domains)
+        self.visual_overlay = {}
+
+    def as_numpy(self):
+        """The cells as a (height, width) numpy array sharing memory with the map."""
+        import numpy as np
+        return np.frombuffer(self.original_tiles, dtype=typecode_of(self.original_tiles)).reshape(self.dimensions[1], self.dimensions[0])
+
+    def get_tile(self, pos: Position):
+        return self.tileset.decode(self.get_domain(pos))
+
+    @staticmethod
+    def from_codes(dimensions: tuple[int, int], tileset: Tileset, codes: array, looping: bool = False):
+        """Wraps an array of cell codes in a map, without copying it."""
+        new_map = Map()
+        new_map.dimensions = dimensions
+        new_map.tileset = tileset
+        new_map.looping = looping
+        new_map.original_tiles = codes
+        return new_map
 
     def get_patch(self, pos: Position, dimensions: tuple[int, int]):
-        map = Map()
-        map.dimensions = dimensions
-        map.set_tileset(self.tileset)
-        for i in range(dimensions[0]):
-            for j in range(dimensions[1]):
-                get_tile = pos + (i, j)
-                map.set_tile(Position(i, j), self.get_tile(get_tile))
-        return map
+        codes = read_window(self.original_tiles, self.dimensions, pos, dimensions, self.looping)
+        if instrumentation.active is not None:
+            instrumentation.active.count("patch_cells_read", len(codes))
+        return Map.from_codes(dimensions, self.tileset, codes)
 
     def get_self_as_map(self):
         return self.get_patch(Position(0, 0), self.dimensions)
 
     def apply_patch(self, pos: Position, patch_map):
-        for i in range(patch_map.dimensions[0]):
-            for j in range(patch_map.dimensions[1]):
-                target = pos + (i, j)
-                self.set_tile(target, patch_map.get_tile(Position(i, j)))
+        codes = patch_map.original_tiles
+        if codes.itemsize > self.original_tiles.itemsize:
+            self.original_tiles = array(typecode_of(codes), self.original_tiles)
+        elif typecode_of(codes) != typecode_of(self.original_tiles):
+            codes = array(typecode_of(self.original_tiles), codes)
+        write_window(self.original_tiles, self.dimensions, pos, patch_map.dimensions, self.looping, codes)
+        if instrumentation.active is not None:
+            instrumentation.active.count("patch_cells_written", len(codes))
+        if self.visual_overlay:
+            # Like set_domain, overwriting a cell clears what was drawn over it
+            width, height = self.dimensions
+            for index in list(self.visual_overlay):
+                if ((index % width - pos.x) % width < patch_map.dimensions[0]
+                        and (index // width - pos.y) % height < patch_map.dimensions[1]):
+                    del self.visual_overlay[index]
 
 
     def get_dimensions(self):
@@ -72,43 +143,29 @@ class Map:
         return self.tileset
 
     def get_visual_tile(self, pos: Position):
-        x = pos.x
-        y = pos.y
-        if self.looping:
-            x = x % self.dimensions[0]
-            y = y % self.dimensions[1]
-        return self.visual_tiles[y * self.dimensions[0] + x]
+        index = self.index(pos)
+        return self.tileset.decode(self.visual_overlay.get(index, self.original_tiles[index]))
 
     def get_tile_string(self, pos: Position):
         tile = self.get_visual_tile(pos)
         if isinstance(tile, set):
             tile = "e"
-        return self.tileset.colors.get(tile, colorama.Style.RESET_ALL) + tile
+        return ansi_color(self.tileset.colors.get(tile)) + tile
 
     def set_tile(self, pos: Position, value: str | set[str]):
-        x = pos.x
-        y = pos.y
-        if self.looping:
-            x = x % self.dimensions[0]
-            y = y % self.dimensions[1]
-        self.original_tiles[y * self.dimensions[0] + x] = value
-        self.visual_tiles[y * self.dimensions[0] + x] = value
+        self.set_domain(pos, self.tileset.encode(value))
 
     def set_visual_tile(self, pos, value: str):
-        x = pos.x
-        y = pos.y
-        if self.looping:
-            x = x % self.dimensions[0]
-            y = y % self.dimensions[1]
-        self.visual_tiles[y * self.dimensions[0] + x] = value
+        index = self.index(pos)
+        self.visual_overlay[index] = self.tileset.encode(value)
+        if self.changed_cells is not None:
+            self.changed_cells.add(index)
 
     def clear_visual_tile(self, pos):
-        x = pos.x
-        y = pos.y
-        if self.looping:
-            x = x % self.dimensions[0]
-            y = y % self.dimensions[1]
-        self.visual_tiles[y * self.dimensions[0] + x] = self.original_tiles[y * self.dimensions[0] + x]
+        index = self.index(pos)
+        self.visual_overlay.pop(index, None)
+        if self.changed_cells is not None:
+            self.changed_cells.add(index)
 
     def get_valid_directions(self, pos: Position):
         return_directions = set()
@@ -129,39 +186,152 @@ class Map:
             If the new dimensions are large, tesselate.
             Note: due to implementation, this clears all visual tiles
         """
-        was_looping = self.looping
-        self.looping = True
-        new_tiles = []
-        for i in range(new_dimensions[0]):
-            for j in range(new_dimensions[1]):
-                target = Position(i, j)
-                new_tiles.append(self.get_tile(target))
-        # Deeply copy the new tiles, to avoid accidentally
-        # Setting original and visual tiles to the same object
-        # By reference, syncing them
-        self.original_tiles = copy.deepcopy(new_tiles)
-        self.visual_tiles = copy.deepcopy(new_tiles)
+        width, height = self.dimensions
+        new_width = new_dimensions[0]
+        repeats = -(-new_width // width)
+        typecode = typecode_of(self.original_tiles)
+        new_tiles = array(typecode)
+        rows = []
+        for j in range(height):
+            row = array(typecode)
+            row.frombytes(span_bytes(self.original_tiles, j * width, width))
+            rows.append((row * repeats)[:new_width])
+        for j in range(new_dimensions[1]):
+            new_tiles.extend(rows[j % height])
+        self.original_tiles = new_tiles
+        self.visual_overlay = {}
         self.dimensions = new_dimensions
-        self.looping = was_looping
 
     # sets tiles in grid
     def __str__(self):
-        return_string = ""
-        for i in range(self.dimensions[1]):
-            for j in range(self.dimensions[0]):
-                return_string += self.get_tile_string(Position(j, i))
-            # Avoid trailing newline
-            if i != self.dimensions[1] - 1:
-                return_string += "\n"
-        return_string += colorama.Style.RESET_ALL
-        return return_string
+        return self.render()
 
     def print_debug(self):
-        return_string = ""
-        for i in range(self.dimensions[1]):
-            for j in range(self.dimensions[0]):
-                return_string += str(self.get_tile(Position(j, i)))
-            # Avoid trailing newline
-            if i != self.dimensions[1] - 1:
-                return_string += "\n"
-        print(return_string)
+        print(self.render(color=False, visual=False, debug=True))
+
+    def render(self, stream=None, pos: Position | None = None, dimensions: tuple[int, int] | None = None, color: bool = True, visual: bool = True, debug: bool = False):
+        """
+            Draws the map (or the dimensions sized window at pos) as text,
+            one character per cell, coloured with ANSI escapes.
+            An escape is only written where the colour changes, and each row
+            goes out as one string. Written to stream if given, otherwise
+            returned.
+            visual shows the visual overlay, and debug shows undecided cells
+            as their set of options instead of "e".
+        """
+        if pos is None:
+            pos = Position(0, 0)
+        if dimensions is None:
+            dimensions = self.dimensions
+        tiles = self.original_tiles
+        overlay = self.visual_overlay if visual else {}
+        cells = {}
+        current = None
+        lines = []
+        row = []
+        for start, window_index, length in row_spans(self.dimensions, pos, dimensions, self.looping):
+            if window_index % dimensions[0] == 0 and window_index:
+                line = "".join(row)
+                row = []
+                if stream is None:
+                    lines.append(line)
+                else:
+                    stream.write(line + "\n")
+            codes = tiles[start:start + length].tolist()
+            if overlay:
+                for index, code in overlay.items():
+                    if start <= index < start + length:
+                        codes[index - start] = code
+            for code, run in itertools.groupby(codes):
+                cell = cells.get(code)
+                if cell is None:
+                    cell = cells[code] = self.render_cell(code, debug)
+                symbol, escape = cell
+                if color and escape != current:
+                    row.append(escape)
+                    current = escape
+                row.append(symbol * len(list(run)))
+        if color:
+            row.append(RESET)
+        if stream is not None:
+            stream.write("".join(row))
+            return None
+        lines.append("".join(row))
+        return "\n".join(lines)
+
+    def render_cell(self, code: int, debug: bool = False):
+        """The text and colour escape for a cell code."""
+        tile = self.tileset.decode(code)
+        if isinstance(tile, set):
+            return (str(tile) if debug else "e"), RESET
+        return tile, ansi_color(self.tileset.colors.get(tile))
+
+
+def ansi_color(color: str | None):
+    """Turns a tileset colour (an escape already, or "#rrggbb") into an ANSI escape."""
+    if color is None:
+        return RESET
+    if color.startswith("#") and len(color) == 7:
+        return f"\x1b[38;2;{int(color[1:3], 16)};{int(color[3:5], 16)};{int(color[5:7], 16)}m"
+    return color
+
+
+def typecode_of(codes: array | memoryview):
+    """The array typecode of a map's cells, whichever way they are stored."""
+    return codes.typecode if isinstance(codes, array) else codes.format
+
+
+def span_bytes(codes: array | memoryview, start: int, length: int):
+    """
+        The raw bytes of cells start..start + length, without copying them.
+        array.frombytes only takes byte buffers, not wider cell codes.
+    """
+    return memoryview(codes)[start:start + length].cast("B")
+
+
+def read_window(cells: array | memoryview, map_dimensions: tuple[int, int], pos: Position, dimensions: tuple[int, int], looping: bool):
+    """Copies a window out of a map's cells into a new array of the same typecode."""
+    codes = array(typecode_of(cells))
+    # Spans come out in window order, so they can simply be appended
+    for start, _, length in row_spans(map_dimensions, pos, dimensions, looping):
+        codes.frombytes(span_bytes(cells, start, length))
+    return codes
+
+
+def write_window(cells: array | memoryview, map_dimensions: tuple[int, int], pos: Position, dimensions: tuple[int, int], looping: bool, codes: array):
+    """Copies codes, a window's cells in the same typecode as cells, into a map's cells at pos."""
+    for start, offset, length in row_spans(map_dimensions, pos, dimensions, looping):
+        cells[start:start + length] = codes[offset:offset + length]
+
+
+def row_spans(map_dimensions: tuple[int, int], pos: Position, dimensions: tuple[int, int], looping: bool = True):
+    """
+        Splits a window of a map into runs of cells that are next to each
+        other in memory, one or two per row of the window.
+        The window is split where it wraps around the edges of the map into
+        at most four rectangles (more only if it is bigger than the map).
+        Yields (map index, window index, length) for each run.
+    """
+    width, height = map_dimensions
+    columns = list(split_span(pos.x, dimensions[0], width, looping))
+    for y, window_y, rows in split_span(pos.y, dimensions[1], height, looping):
+        for j in range(rows):
+            row = (y + j) * width
+            window_row = (window_y + j) * dimensions[0]
+            for x, window_x, length in columns:
+                yield row + x, window_row + window_x, length
+
+
+def split_span(start: int, length: int, size: int, looping: bool):
+    """Splits start..start + length into pieces inside 0..size, yielding (start, offset, length)."""
+    if not looping:
+        if start < 0 or start + length > size:
+            raise IndexError(f"{start}..{start + length} is outside 0..{size}")
+        yield start, 0, length
+        return
+    done = 0
+    while done < length:
+        piece_start = (start + done) % size
+        piece_length = min(length - done, size - piece_start)
+        yield piece_start, done, piece_length
+        done += piece_length
@@ -1,48 +1,91 @@
 import tkinter as tk
 from position import Position
+from image_render import MARKER_COLORS, code_color, ppm_bytes, rasterize
 from goal import GoalManager
 from tileset import Tileset
-from wavefunction_collapse import map_generation_chunked
+from levels import grow_dimensions, level_chunk_dimensions
+from wavefunction_collapse import ChunkedGenerator
 
 class MapVisualizer:
-    def __init__(self, map, player):
+    def __init__(self, map, player, generator=None, viewport=(40, 25), cell_size=30, levels=None):
         self.map = map
         self.player = player
+        self.generator = generator  # Kept across restarts so its workers are reused
+        self.levels = levels  # Next levels, generated in the background (see levels.LevelQueue)
         self.goal_manager = GoalManager(map, player)  # Pass the player object to GoalManager
-        self.cell_size = 30  # Size of each cell in pixels
-        self.colors = {
-            # "B": "#D2B48C",  # Tan (beach color)
-            # "L": "#556B2F",  # Dark Olive Green (land color)
-            # "O": "#4682B4",  # Steel Blue (ocean color)
-            "P": "#FF4500",  # Orange Red (Player color)
-            "U": "#4B0082",  # Indigo (Button color)
-            "C": "#9500ff",  # Brighter Purple (Pressed button color)
-            "R": "#8B0000",  # Dark Red (Locked goal color)
-            "G": "#dcaf09"   # Gold (Unlocked goal color)
-        }
+        self.cell_size = cell_size  # Size of each cell in pixels
+        self.colors = dict(MARKER_COLORS)
+        # Only the cells in the viewport get canvas items, and the viewport
+        # follows the player around maps bigger than it
+        self.viewport = (min(viewport[0], self.map.dimensions[0]), min(viewport[1], self.map.dimensions[1]))
+        self.origin = Position(0, 0)
+        self.items = []  # Canvas item of each viewport cell, row by row
+        self.code_colors = {}
+        self.map.track_changes()
         self.root = tk.Tk()
         self.root.focus_force()  # Ensure the new window is the active window
-        self.canvas = tk.Canvas(self.root, width=self.map.dimensions[0] * self.cell_size, height=self.map.dimensions[1] * self.cell_size)
+        self.canvas = tk.Canvas(self.root, width=self.viewport[0] * self.cell_size, height=self.viewport[1] * self.cell_size)
         self.canvas.pack()
 
+    def cell_color(self, index):
+        code = self.map.visual_overlay.get(index, self.map.original_tiles[index])
+        color = self.code_colors.get(code)
+        if color is None:
+            color = self.code_colors[code] = code_color(self.map, code, self.colors)
+        return color
+
+    def follow_player(self):
+        """Moves the viewport so the player stays away from its edges. Returns whether it moved."""
+        margin_x = self.viewport[0] // 4
+        margin_y = self.viewport[1] // 4
+        x, y = self.origin
+        if self.player.pos.x < x + margin_x:
+            x = self.player.pos.x - margin_x
+        elif self.player.pos.x >= x + self.viewport[0] - margin_x:
+            x = self.player.pos.x - self.viewport[0] + margin_x + 1
+        if self.player.pos.y < y + margin_y:
+            y = self.player.pos.y - margin_y
+        elif self.player.pos.y >= y + self.viewport[1] - margin_y:
+            y = self.player.pos.y - self.viewport[1] + margin_y + 1
+        x = max(0, min(x, self.map.dimensions[0] - self.viewport[0]))
+        y = max(0, min(y, self.map.dimensions[1] - self.viewport[1]))
+        moved = (x, y) != self.origin
+        self.origin = Position(x, y)
+        return moved
+
     def draw_map(self):
-        self.canvas.delete("all")  # Clear the canvas
-        for y in range(self.map.dimensions[1]):
-            for x in range(self.map.dimensions[0]):
-                tile = self.map.get_visual_tile(Position(x, y))
-                if isinstance(tile, set):
-                    tile = next(iter(tile)) if len(tile) == 1 else "e"  # Extract single element or default to 'e'
-                color = self.map.tileset.get_color(tile)
-                if color is None:
-                    color = self.colors.get(tile, "white")  # Default to white if no color is defined
-                self.canvas.create_rectangle(
-                    x * self.cell_size, y * self.cell_size,
-                    (x + 1) * self.cell_size, (y + 1) * self.cell_size,
-                    fill=color, outline="black"
-                )
+        """Colours every cell in the viewport, creating the canvas items the first time."""
+        self.follow_player()
+        self.map.take_changes()
+        width = self.map.dimensions[0]
+        create = not self.items
+        for y in range(self.viewport[1]):
+            row = (self.origin.y + y) * width + self.origin.x
+            for x in range(self.viewport[0]):
+                color = self.cell_color(row + x)
+                if create:
+                    self.items.append(self.canvas.create_rectangle(
+                        x * self.cell_size, y * self.cell_size,
+                        (x + 1) * self.cell_size, (y + 1) * self.cell_size,
+                        fill=color, outline="black"
+                    ))
+                else:
+                    self.canvas.itemconfig(self.items[y * self.viewport[0] + x], fill=color)
+
+    def draw_changes(self):
+        """Recolours just the cells that changed since the last draw."""
+        width = self.map.dimensions[0]
+        for index in self.map.take_changes():
+            x = index % width - self.origin.x
+            y = index // width - self.origin.y
+            if 0 <= x < self.viewport[0] and 0 <= y < self.viewport[1]:
+                self.canvas.itemconfig(self.items[y * self.viewport[0] + x], fill=self.cell_color(index))
 
     def update(self):
-        self.draw_map()
+        if not self.items or self.follow_player():
+            self.draw_map()
+        else:
+            self.draw_changes()
         self.root.update_idletasks()  # Ensure the canvas updates properly
         self.root.update()
 
@@ -50,18 +93,86 @@ class MapVisualizer:
         self.draw_map()
         self.root.mainloop()
 
-def restart_game(map_visualizer):
-    from player import Player
-    import random
+class ImageVisualizer(MapVisualizer):
+    """
+        A MapVisualizer that shows the viewport as a single image, drawn
+        by rasterize, instead of a canvas item per cell, so it keeps up
+        with maps far bigger than a window.
+        The mouse wheel or +/- zooms, and dragging with the mouse pans
+        until the player next walks out of view.
+    """
+    def __init__(self, map, player, generator=None, window=(960, 720), zoom=8, levels=None):
+        self.window = window
+        self.zoom = zoom
+        self.photo = None
+        self.drag_start = None
+        super().__init__(map, player, generator, viewport=(window[0] // zoom, window[1] // zoom), cell_size=zoom, levels=levels)
+        self.image_item = self.canvas.create_image(0, 0, anchor="nw")
+        self.root.bind("<plus>", lambda event: self.set_zoom(self.zoom * 2))
+        self.root.bind("<equal>", lambda event: self.set_zoom(self.zoom * 2))
+        self.root.bind("<minus>", lambda event: self.set_zoom(self.zoom // 2))
+        self.root.bind("<MouseWheel>", lambda event: self.set_zoom(self.zoom * 2 if event.delta > 0 else self.zoom // 2))
+        self.root.bind("<Button-4>", lambda event: self.set_zoom(self.zoom * 2))  # Wheel on X11
+        self.root.bind("<Button-5>", lambda event: self.set_zoom(self.zoom // 2))
+        self.canvas.bind("<ButtonPress-1>", self.start_drag)
+        self.canvas.bind("<B1-Motion>", self.drag)
 
-    # Close the current window
-    map_visualizer.root.destroy()
+    def set_zoom(self, zoom):
+        """Changes the pixels per cell, keeping the middle of the view where it is."""
+        zoom = max(1, min(zoom, 64))
+        if zoom == self.zoom:
+            return
+        middle = self.origin + (self.viewport[0] // 2, self.viewport[1] // 2)
+        self.zoom = self.cell_size = zoom
+        self.photo = None  # Redrawn even if the view hasn't moved
+        self.viewport = (min(self.window[0] // zoom, self.map.dimensions[0]), min(self.window[1] // zoom, self.map.dimensions[1]))
+        self.canvas.config(width=self.viewport[0] * zoom, height=self.viewport[1] * zoom)
+        self.pan_to(middle.x - self.viewport[0] // 2, middle.y - self.viewport[1] // 2)
+
+    def start_drag(self, event):
+        self.drag_start = (event.x, event.y, self.origin)
+
+    def drag(self, event):
+        x, y, origin = self.drag_start
+        self.pan_to(origin.x - (event.x - x) // self.zoom, origin.y - (event.y - y) // self.zoom)
 
-    # Increase dimensions
-    map_visualizer.map.dimensions = (
-        min(map_visualizer.map.dimensions[0] + random.randint(1, 5), 32),
-        min(map_visualizer.map.dimensions[1] + random.randint(1, 5), 32)
-    )
+    def pan_to(self, x, y):
+        x = max(0, min(x, self.map.dimensions[0] - self.viewport[0]))
+        y = max(0, min(y, self.map.dimensions[1] - self.viewport[1]))
+        if self.photo is None or (x, y) != self.origin:
+            self.origin = Position(x, y)
+            self.redraw()
+
+    def redraw(self):
+        """Draws the whole viewport as one image."""
+        self.map.take_changes()
+        pixels = rasterize(self.map, self.origin, self.viewport, self.zoom, colors=self.colors)
+        self.photo = tk.PhotoImage(data=ppm_bytes(pixels), format="PPM")
+        self.canvas.itemconfig(self.image_item, image=self.photo)
+
+    def draw_map(self):
+        self.follow_player()
+        self.redraw()
+
+    def draw_changes(self):
+        """Paints just the cells that changed since the last draw into the image."""
+        width = self.map.dimensions[0]
+        for index in self.map.take_changes():
+            x = index % width - self.origin.x
+            y = index // width - self.origin.y
+            if 0 <= x < self.viewport[0] and 0 <= y < self.viewport[1]:
+                self.photo.put(self.cell_color(index), to=(x * self.zoom, y * self.zoom, (x + 1) * self.zoom, (y + 1) * self.zoom))
+
+    def update(self):
+        if self.photo is None or self.follow_player():
+            self.redraw()
+        else:
+            self.draw_changes()
+        self.root.update_idletasks()
+        self.root.update()
+
+def restart_game(map_visualizer):
+    from player import Player
 
     # Regenerate the map
     # tile_options = {"L", "B", "O"}
@@ -86,12 +197,22 @@ def restart_game(map_visualizer):
     #     },
     # }
     # tileset = Tileset(tile_options, rules)
-    tileset = Tileset.parse_json("default_tileset.json")
+    generator = map_visualizer.generator
+    levels = map_visualizer.levels
     # map_visualizer.map = Map(map_visualizer.map.dimensions, tileset)
     # map_generation(map_visualizer.map)
-    dimensions = (map_visualizer.map.dimensions)
-    chunk_dimensions = (min(dimensions[0] // 4, 32), min(dimensions[1] // 4, 32))
-    map_visualizer.map = map_generation_chunked(tileset, dimensions, chunk_dimensions, num_threads=8)
+    if levels is not None:
+        # Usually already generated while this level was played
+        new_map = levels.take()
+    else:
+        if generator is None:
+            generator = ChunkedGenerator(Tileset.parse_json("default_tileset.json"), num_threads=8)
+        dimensions = grow_dimensions(map_visualizer.map.dimensions)
+        new_map = generator.generate(dimensions, level_chunk_dimensions(dimensions))
+
+    # Close the current window, once the next level is there to replace it
+    map_visualizer.root.destroy()
+    map_visualizer.map = new_map
 
     # Reinitialize the player
     map_visualizer.player = Player(map_visualizer.map.dimensions)
@@ -100,7 +221,7 @@ def restart_game(map_visualizer):
     map_visualizer.player.update_map(map_visualizer.map)
 
     # Reinitialize the MapVisualizer
-    new_visualizer = MapVisualizer(map_visualizer.map, map_visualizer.player)
+    new_visualizer = type(map_visualizer)(map_visualizer.map, map_visualizer.player, generator, levels=levels)
 
     # Rebind key listeners
     def on_keypress(event):
@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import zlib
+from array import array
+from collections import OrderedDict
+from file_utils import atomic_write
+from map import Map, typecode_of
+from map_file import MapFile, save_map
+from tileset import Tileset
+from wavefunction_collapse import map_generation_chunked, ChunkedGenerator
+
+
+class MapCache:
+    """
+        Generated maps, looked up by everything that decides what they look
+        like: the tileset's rules, dimensions, chunk size, looping, engine,
+        selection and seed.
+        The max_entries most recently used maps are kept in memory. Every
+        map is also written to cache_dir, which is trimmed back to
+        max_disk_bytes by removing the least recently used files.
+        Maps handed out are copies, so changing one doesn't change the cache.
+    """
+    def __init__(self, cache_dir: str = "map_cache", max_entries: int = 8, max_disk_bytes: int = 256 * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_disk_bytes = max_disk_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.maps: OrderedDict[str, Map] = OrderedDict()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(tileset: Tileset, dimensions: tuple[int, int], chunk_dimensions: tuple[int, int], looping: bool, seed: int, engine: str = "scalar", selection: str = "scanline"):
+        parameters = [tileset.fingerprint(), list(dimensions), list(chunk_dimensions), looping, seed, engine]
+        if selection != "scanline":
+            # Scanline maps keep the keys they had before selection was added
+            parameters.append(selection)
+        return hashlib.sha256(json.dumps(parameters).encode()).hexdigest()
+
+    def generate(self, tileset: Tileset, dimensions: tuple[int, int], chunk_dimensions: tuple[int, int], looping: bool = False, seed: int = 0, engine: str = "scalar", num_threads: int = 1, generator: ChunkedGenerator | None = None, selection: str = "scanline"):
+        """
+            Like map_generation_chunked, but only generates maps it hasn't
+            seen before. With a generator, its tileset, workers, engine and
+            selection are used instead of tileset, num_threads, engine and
+            selection.
+        """
+        if generator is not None:
+            tileset = generator.tileset
+            engine = generator.engine
+            selection = generator.selection
+        key = MapCache.key(tileset, dimensions, chunk_dimensions, looping, seed, engine, selection)
+        cached = self.get(key, tileset)
+        if cached is not None:
+            return cached
+        self.misses += 1
+        if generator is not None:
+            new_map = generator.generate(dimensions, chunk_dimensions, looping, seed)
+        else:
+            new_map = map_generation_chunked(tileset, dimensions, chunk_dimensions, num_threads=num_threads, looping=looping, engine=engine, seed=seed, selection=selection)
+        self.put(key, new_map)
+        return copy_map(new_map)
+
+    def get(self, key: str, tileset: Tileset):
+        """The map stored under key, or None."""
+        cached = self.maps.get(key)
+        if cached is not None:
+            self.maps.move_to_end(key)
+            self.hits += 1
+            return copy_map(cached)
+        path = self.path(key)
+        try:
+            with MapFile(path, tileset) as map_file:
+                cached = map_file.view()
+        except (OSError, ValueError, zlib.error):
+            return None
+        # Touched so the disk store can tell what was used recently
+        os.utime(path)
+        self.disk_hits += 1
+        self.remember(key, cached)
+        return copy_map(cached)
+
+    def put(self, key: str, new_map: Map):
+        self.remember(key, copy_map(new_map))
+        path = self.path(key)
+        atomic_write(path, lambda temporary: save_map(new_map, temporary, compression="zlib"))
+        self.trim_disk()
+
+    def remember(self, key: str, cached: Map):
+        self.maps[key] = cached
+        self.maps.move_to_end(key)
+        while len(self.maps) > self.max_entries:
+            self.maps.popitem(last=False)
+
+    def trim_disk(self):
+        entries = []
+        total = 0
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".map"):
+                info = entry.stat()
+                entries.append((info.st_mtime, info.st_size, entry.path))
+                total += info.st_size
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_disk_bytes:
+                break
+            os.remove(path)
+            total -= size
+            self.evictions += 1
+
+    def path(self, key: str):
+        return os.path.join(self.cache_dir, key + ".map")
+
+    def clear(self):
+        self.maps.clear()
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".map"):
+                os.remove(entry.path)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.disk_hits) / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "resident": len(self.maps),
+        }
+
+
+def copy_map(source: Map):
+    return Map.from_codes(source.get_dimensions(), source.get_tileset(), array(typecode_of(source.original_tiles), source.original_tiles), source.looping)
@@ -0,0 +1,160 @@
+import json
+import mmap
+import struct
+import zlib
+from array import array
+from position import Position
+from map import Map, read_window, row_spans, typecode_of
+from tileset import Tileset
+
+# Magic, format version and header length, followed by a json header
+PREAMBLE = struct.Struct("<8sHI")
+MAGIC = b"WFCMAP\0\0"
+VERSION = 1
+# The cell codes start on a multiple of this, so they can be viewed in place
+ALIGNMENT = 8
+
+
+def save_map(map: Map, path: str, compression: str = "none", block_rows: int = 64):
+    with open(path, "wb") as file:
+        write_map(map, file, compression, block_rows)
+
+
+def write_map(map: Map, file, compression: str = "none", block_rows: int = 64):
+    """
+        Writes map to a binary file: the preamble, a json header with the
+        dimensions, the looping flag and the tileset, then the cell codes.
+        compression is "none", which lets load_map view the file in place,
+        or "zlib", which compresses each block of block_rows rows on its own
+        so a region can be read without inflating the rest.
+    """
+    if compression not in {"none", "zlib"}:
+        raise ValueError(f"Unknown compression {compression}")
+    width, height = map.get_dimensions()
+    codes = map.original_tiles
+    typecode = typecode_of(codes)
+    header = {
+        "dimensions": [width, height],
+        "looping": map.looping,
+        "typecode": typecode,
+        "tileset": map.get_tileset().to_dict(),
+        "compression": compression,
+    }
+    blocks = []
+    if compression == "zlib":
+        row_bytes = width * codes.itemsize
+        raw = memoryview(codes).cast("B")
+        # Where each block starts in the data and how long it is
+        header["block_rows"] = block_rows
+        header["blocks"] = []
+        offset = 0
+        for first_row in range(0, height, block_rows):
+            block = zlib.compress(raw[first_row * row_bytes:(first_row + block_rows) * row_bytes], 6)
+            blocks.append(block)
+            header["blocks"].append([offset, len(block)])
+            offset += len(block)
+    header_bytes = json.dumps(header).encode()
+    start = PREAMBLE.size + len(header_bytes)
+    padding = -start % ALIGNMENT
+    file.write(PREAMBLE.pack(MAGIC, VERSION, len(header_bytes)))
+    file.write(header_bytes)
+    file.write(b"\0" * padding)
+    if compression == "zlib":
+        for block in blocks:
+            file.write(block)
+    else:
+        file.write(memoryview(codes).cast("B"))
+
+
+class MapFile:
+    """
+        A saved map, opened with mmap so only the parts that are used get
+        read from disk.
+        view() gives a Map on top of the file itself; writes to it stay in
+        memory. read_region() copies out one rectangle, touching only the
+        pages (or compressed blocks) holding those rows.
+        The file's own tileset is used unless one is given, in which case
+        it must be the same tileset.
+    """
+    def __init__(self, path: str, tileset: Tileset | None = None):
+        # The mapping keeps its own handle on the file
+        with open(path, "rb") as file:
+            magic, version, header_length = PREAMBLE.unpack(file.read(PREAMBLE.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not a map file")
+            if version > VERSION:
+                raise ValueError(f"{path} is version {version}, only {VERSION} and older can be read")
+            self.header = json.loads(file.read(header_length))
+            self.mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_COPY)
+        start = PREAMBLE.size + header_length
+        self.data_offset = start + -start % ALIGNMENT
+        self.dimensions = tuple(self.header["dimensions"])
+        self.looping = self.header["looping"]
+        self.typecode = self.header["typecode"]
+        self.itemsize = array(self.typecode).itemsize
+        if tileset is None:
+            tileset = Tileset.from_dict(self.header["tileset"])
+        else:
+            # Codes only mean the same thing if the tiles got the same bits
+            tileset.match_tile_order(self.header["tileset"]["tile_order"])
+        self.tileset = tileset
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        try:
+            self.mmap.close()
+        except BufferError:
+            # A view is still using it; it goes when the last view does
+            pass
+
+    def cells(self):
+        """The uncompressed cell codes, as a view of the mapped file."""
+        size = self.dimensions[0] * self.dimensions[1] * self.itemsize
+        return memoryview(self.mmap)[self.data_offset:self.data_offset + size].cast(self.typecode)
+
+    def view(self):
+        """The whole map. Uncompressed files aren't read until cells are used."""
+        if self.header["compression"] == "none":
+            codes = self.cells()
+        else:
+            codes = array(self.typecode)
+            for block in range(len(self.header["blocks"])):
+                codes.frombytes(self.read_block(block))
+        return Map.from_codes(self.dimensions, self.tileset, codes, self.looping)
+
+    def read_region(self, pos: Position, dimensions: tuple[int, int]):
+        """Copies one rectangle of the map out, wrapping around the edges of looping maps."""
+        if self.header["compression"] == "none":
+            codes = read_window(self.cells(), self.dimensions, pos, dimensions, self.looping)
+            return Map.from_codes(dimensions, self.tileset, codes)
+        codes = array(self.typecode)
+        width = self.dimensions[0]
+        block_rows = self.header["block_rows"]
+        blocks = {}
+        for start, _, length in row_spans(self.dimensions, pos, dimensions, self.looping):
+            block = start // width // block_rows
+            if block not in blocks:
+                blocks[block] = self.read_block(block)
+            offset = (start - block * block_rows * width) * self.itemsize
+            codes.frombytes(blocks[block][offset:offset + length * self.itemsize])
+        return Map.from_codes(dimensions, self.tileset, codes)
+
+    def read_block(self, block: int):
+        offset, length = self.header["blocks"][block]
+        start = self.data_offset + offset
+        return zlib.decompress(self.mmap[start:start + length])
+
+
+def load_map(path: str, tileset: Tileset | None = None):
+    """Loads a whole map. Uncompressed files are mapped rather than read."""
+    return MapFile(path, tileset).view()
+
+
+def read_region(path: str, pos: Position, dimensions: tuple[int, int], tileset: Tileset | None = None):
+    with MapFile(path, tileset) as map_file:
+        return map_file.read_region(pos, dimensions)
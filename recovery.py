@@ -0,0 +1,67 @@
+from array import array
+from position import Position
+
+
+class Contradiction(ValueError):
+    """Raised when propagation leaves a cell with no options."""
+    def __init__(self, position: Position):
+        super().__init__(f"No options left at {position}")
+        self.position = position
+
+
+class Trail:
+    """
+        Undo log of the domain changes made since the last decision,
+        stored as flat (index, old mask) pairs.
+    """
+    def __init__(self):
+        self.entries = array("q")
+
+    def __len__(self):
+        return len(self.entries) // 2
+
+    def record(self, index: int, old_mask: int):
+        self.entries.append(index)
+        self.entries.append(old_mask)
+
+    def clear(self):
+        del self.entries[:]
+
+    def undo(self, map, frontier=None):
+        """Restores every recorded cell, newest change first."""
+        entries = self.entries
+        for i in range(len(entries) - 2, -1, -2):
+            map.set_domain_index(entries[i], entries[i + 1])
+            if frontier is not None:
+                frontier.update(entries[i], entries[i + 1])
+        self.clear()
+
+
+class RecoveryPolicy:
+    """
+        How hard generation tries to get past a contradiction, and how often
+        it had to.
+        A failed collapse is undone and the tile banned from that cell, up to
+        max_backtracks times. After that, every undecided cell within
+        restart_radius of the failure is reset and solved again, growing the
+        area on each failed attempt, max_restarts times at most.
+        Restarts may nest max_depth deep before giving up.
+    """
+    def __init__(self, max_backtracks: int = 3, restart_radius: int = 2, max_restarts: int = 8, max_depth: int = 4):
+        self.max_backtracks = max_backtracks
+        self.restart_radius = restart_radius
+        self.max_restarts = max_restarts
+        self.max_depth = max_depth
+        self.trail = Trail()
+        self.contradictions = 0
+        self.backtracks = 0
+        self.restarts = 0
+        self.cells_resolved = 0
+
+    def stats(self):
+        return {
+            "contradictions": self.contradictions,
+            "backtracks": self.backtracks,
+            "restarts": self.restarts,
+            "cells_resolved": self.cells_resolved,
+        }
@@ -0,0 +1,67 @@
+from array import array
+import multiprocessing.shared_memory
+import instrumentation
+from position import Position
+from map import Map, read_window, span_bytes, write_window
+from tileset import Tileset
+
+
+class SharedGrid:
+    """
+        A map's cell codes in a shared memory block, so worker processes can
+        read and write windows of it directly instead of going through a
+        manager process one tile at a time.
+        Windows wrap around the edges if the map is looping, and must fit
+        inside it otherwise, the same as Map.get_patch (see row_spans).
+    """
+    def __init__(self, shared_memory: multiprocessing.shared_memory.SharedMemory, dimensions: tuple[int, int], typecode: str, looping: bool):
+        self.shared_memory = shared_memory
+        self.dimensions = dimensions
+        self.typecode = typecode
+        self.looping = looping
+        self.cells = shared_memory.buf.cast(typecode)
+
+    @staticmethod
+    def create(map: Map):
+        """Allocates a new block holding a copy of map's cells."""
+        typecode = map.get_tileset().code_typecode()
+        codes = array(typecode, map.original_tiles)
+        shared_memory = multiprocessing.shared_memory.SharedMemory(create=True, size=max(len(codes) * codes.itemsize, 1))
+        grid = SharedGrid(shared_memory, map.get_dimensions(), typecode, map.looping)
+        grid.cells[:len(codes)] = codes
+        return grid
+
+    @staticmethod
+    def attach(descriptor: tuple):
+        name, dimensions, typecode, looping = descriptor
+        return SharedGrid(multiprocessing.shared_memory.SharedMemory(name=name), dimensions, typecode, looping)
+
+    def descriptor(self):
+        """What another process needs to attach to this grid."""
+        return (self.shared_memory.name, self.dimensions, self.typecode, self.looping)
+
+    def read_patch(self, pos: Position, dimensions: tuple[int, int], tileset: Tileset):
+        codes = read_window(self.cells, self.dimensions, pos, dimensions, self.looping)
+        if instrumentation.active is not None:
+            instrumentation.active.count("ipc_bytes_read", len(codes) * codes.itemsize)
+        return Map.from_codes(dimensions, tileset, codes)
+
+    def write_patch(self, pos: Position, patch: Map):
+        codes = patch.original_tiles
+        if codes.typecode != self.typecode:
+            codes = array(self.typecode, codes)
+        write_window(self.cells, self.dimensions, pos, patch.get_dimensions(), self.looping, codes)
+        if instrumentation.active is not None:
+            instrumentation.active.count("ipc_bytes_written", len(codes) * codes.itemsize)
+
+    def to_map(self, tileset: Tileset):
+        codes = array(self.typecode)
+        codes.frombytes(span_bytes(self.cells, 0, self.dimensions[0] * self.dimensions[1]))
+        return Map.from_codes(self.dimensions, tileset, codes, self.looping)
+
+    def close(self):
+        self.cells.release()
+        self.shared_memory.close()
+
+    def unlink(self):
+        self.shared_memory.unlink()
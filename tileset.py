@@ -1,16 +1,40 @@
 from position import Direction
+from array import array
+import hashlib
 import json
+import os
+import random
+from file_utils import atomic_write
+
+# Tilesets with at most this many tiles precompute neighbour options for every domain
+TABLE_BITS = 12
+# Larger tilesets remember this many options per direction before starting over
+MEMO_SIZE = 1 << 16
+# Bumped whenever the layout of the compiled files changes
+COMPILED_VERSION = 1
 
 class Tileset:
     def __init__(self, 
                  tiles: set[str] | None = None, 
                  rules: dict[str, dict[Direction, set[str]]] | None = None, 
                  colors: dict[str, str] | None = None,
-                 walkability: dict[str, bool] | None = None):
+                 walkability: dict[str, bool] | None = None,
+                 weights: dict[str, float] | None = None):
         if tiles is not None:
             self.tiles = tiles
         else:
             self.tiles = set()
+        # Every tile (and any marker tile placed on a map later) gets a bit
+        # index, so cell domains can be stored as integer bitmasks.
+        # Indices are only ever appended, so existing masks stay valid.
+        self.tile_order: list[str] = sorted(self.tiles)
+        self.tile_bits: dict[str, int] = {tile: 1 << i for i, tile in enumerate(self.tile_order)}
+        self._rule_masks: dict[Direction, list[int]] | None = None
+        self._option_tables: dict[Direction, list[int]] = {}
+        self._options_memo: dict[Direction, dict[int, int]] = {}
+        self._bit_choices: dict[int, tuple[int, ...]] = {}
+        # (bits, probabilities, aliases) of every domain chosen from so far
+        self._alias_tables: dict[int, tuple] = {}
         if rules is not None:
             for rule in rules:
                 if rule not in self.tiles:
@@ -35,11 +59,15 @@ class Tileset:
             self.walkability = walkability
         else:
             self.walkability: dict[str, bool] = {}
+        self.weights: dict[str, float] = {}
+        if weights is not None:
+            self.set_weights(weights)
 
     def add_rule(self, init_tiles: set[str], directions: set[Direction], terminal_tiles: set[str]):
         if (init_tiles.intersection(self.tiles) != init_tiles 
                 or terminal_tiles.intersection(self.tiles) != terminal_tiles):
             raise ValueError
+        self._rule_masks = None
         for dir in directions:
             for tile in init_tiles:
                 if tile not in self.rules:
@@ -57,16 +85,177 @@ class Tileset:
 
     def add_tiles(self, tiles: set[str]):
         self.tiles = self.tiles.union(tiles)
+        for tile in sorted(tiles):
+            self._add_bit(tile)
+        self._rule_masks = None
 
-    def get_options(self, init_tileset: set[str] | str, direction: Direction):
-        options = set()
-        if isinstance(init_tileset, set):
-            for tile in init_tileset:
-                options = options.union(self.rules[tile][direction])
-        else:
-            options = self.rules[init_tileset][direction]
+    def _add_bit(self, tile: str):
+        if tile not in self.tile_bits:
+            self.tile_bits[tile] = 1 << len(self.tile_order)
+            self.tile_order.append(tile)
+
+    @property
+    def all_mask(self):
+        mask = 0
+        for tile in self.tiles:
+            mask |= self.tile_bits[tile]
+        return mask
+
+    def code_typecode(self):
+        """The smallest array typecode that holds a mask of every tile known so far."""
+        bits = len(self.tile_order)
+        for typecode in ("B", "H", "I", "Q"):
+            if bits <= array(typecode).itemsize * 8:
+                return typecode
+        raise ValueError(f"{bits} tiles don't fit in a 64 bit code")
+
+    def encode(self, value: set[str] | str):
+        """Converts a tile or set of tiles to its bitmask."""
+        if isinstance(value, str):
+            bit = self.tile_bits.get(value)
+            if bit is None:
+                # Tiles outside the tileset (buttons, goals...) still
+                # need a code so they can be stored on the map
+                self._add_bit(value)
+                bit = self.tile_bits[value]
+            return bit
+        mask = 0
+        for tile in value:
+            mask |= self.encode(tile)
+        return mask
+
+    def decode(self, mask: int):
+        """Converts a bitmask back to a tile, or a set of tiles if undecided."""
+        if mask and not mask & (mask - 1):
+            return self.tile_order[mask.bit_length() - 1]
+        return self.decode_set(mask)
+
+    def decode_set(self, mask: int):
+        tiles = set()
+        while mask:
+            bit = mask & -mask
+            tiles.add(self.tile_order[bit.bit_length() - 1])
+            mask ^= bit
+        return tiles
+
+    def bit_choices(self, mask: int):
+        """Returns the single-tile masks contained in mask, cached per mask."""
+        choices = self._bit_choices.get(mask)
+        if choices is None:
+            choices = []
+            remaining = mask
+            while remaining:
+                bit = remaining & -remaining
+                choices.append(bit)
+                remaining ^= bit
+            choices = tuple(choices)
+            self._bit_choices[mask] = choices
+        return choices
+
+    def choose(self, mask: int, rng=random):
+        """
+            Picks one single-tile mask out of mask, in proportion to the
+            tiles' weights. Each domain's alias table is built the first
+            time it's chosen from, after which a choice is one random
+            number and two lookups.
+        """
+        bits, probabilities, aliases = self._alias_tables.get(mask) or self.alias_table(mask)
+        if probabilities is None:
+            # Equal weights pick exactly as they did before tiles had weights
+            return rng.choice(bits)
+        position = rng.random() * len(bits)
+        column = int(position)
+        if position - column < probabilities[column]:
+            return bits[column]
+        return aliases[column]
+
+    def alias_table(self, mask: int):
+        """The (bits, probabilities, aliases) choose uses for mask. probabilities is None if every weight is equal."""
+        table = self._alias_tables.get(mask)
+        if table is None:
+            table = self._alias_tables[mask] = self._alias_table(mask)
+        return table
+
+    def _alias_table(self, mask: int):
+        # Vose's alias method: every column holds its own bit with
+        # probability probabilities[column], and its alias otherwise
+        bits = self.bit_choices(mask)
+        weights = [self.get_weight(self.decode(bit)) for bit in bits]
+        total = sum(weights)
+        if total <= 0 or min(weights) == max(weights):
+            return bits, None, bits
+        scaled = [weight * len(bits) / total for weight in weights]
+        probabilities = [1.0] * len(bits)
+        aliases = list(bits)
+        small = [column for column, value in enumerate(scaled) if value < 1]
+        large = [column for column, value in enumerate(scaled) if value >= 1]
+        while small and large:
+            column = small.pop()
+            donor = large[-1]
+            probabilities[column] = scaled[column]
+            aliases[column] = bits[donor]
+            scaled[donor] -= 1 - scaled[column]
+            if scaled[donor] < 1:
+                small.append(large.pop())
+        # Whatever is left over only differs from 1 by rounding
+        return bits, tuple(probabilities), tuple(aliases)
+
+    def rule_masks(self):
+        """
+            Per direction, a list indexed by tile bit index holding the mask
+            of tiles allowed next to that tile.
+        """
+        if self._rule_masks is None:
+            rule_masks = {}
+            for dir in Direction.all_cardinal():
+                masks = []
+                for tile in self.tile_order:
+                    masks.append(self.encode(self.rules.get(tile, {}).get(dir, set())))
+                rule_masks[dir] = masks
+            self._rule_masks = rule_masks
+            self._option_tables = {}
+            self._options_memo = {dir: {} for dir in rule_masks}
+            # Small tilesets get the union for every possible domain up front
+            if len(self.tile_order) <= TABLE_BITS:
+                for dir in rule_masks:
+                    self._option_tables[dir] = [self._union_masks(rule_masks[dir], mask)
+                                                for mask in range(1 << len(self.tile_order))]
+        return self._rule_masks
+
+    def option_table(self, direction: Direction):
+        """The precomputed options for every domain, or None for large tilesets."""
+        self.rule_masks()
+        return self._option_tables.get(direction)
+
+    def get_options_mask(self, init_mask: int, direction: Direction):
+        masks = self.rule_masks()[direction]
+        table = self._option_tables.get(direction)
+        if table is not None and init_mask < len(table):
+            return table[init_mask]
+        # Maps only ever hold a few distinct domains, so remember them
+        memo = self._options_memo[direction]
+        options = memo.get(init_mask)
+        if options is None:
+            if len(memo) >= MEMO_SIZE:
+                memo.clear()
+            options = self._union_masks(masks, init_mask)
+            memo[init_mask] = options
         return options
 
+    @staticmethod
+    def _union_masks(masks: list[int], init_mask: int):
+        options = 0
+        while init_mask:
+            bit = init_mask & -init_mask
+            index = bit.bit_length() - 1
+            if index < len(masks):
+                options |= masks[index]
+            init_mask ^= bit
+        return options
+
+    def get_options(self, init_tileset: set[str] | str, direction: Direction):
+        return self.decode_set(self.get_options_mask(self.encode(init_tileset), direction))
+
     def add_colors(self, colors: dict[str, str]):
         for i in colors:
             if i not in self.tiles:
@@ -83,11 +272,99 @@ class Tileset:
     def get_color(self, tile: str):
         return self.colors.get(tile, None)
 
+    def set_weights(self, weights: dict[str, float]):
+        """Sets how often tiles are picked relative to each other. Tiles without one have a weight of 1."""
+        for tile, weight in weights.items():
+            if tile not in self.tiles or weight < 0:
+                raise ValueError
+        self.weights.update(weights)
+        self._alias_tables = {}
+
+    def get_weight(self, tile: str):
+        return self.weights.get(tile, 1.0)
+
+    @property
+    def weighted(self):
+        """Whether any tile's weight differs from the default."""
+        return any(weight != 1.0 for weight in self.weights.values())
+
+
+    def match_tile_order(self, tile_order: list[str]):
+        """
+            Gives tiles the bits they had in tile_order, so masks made with
+            it mean the same here. Raises ValueError if that isn't possible.
+        """
+        shared = min(len(tile_order), len(self.tile_order))
+        if tile_order[:shared] != self.tile_order[:shared]:
+            raise ValueError("Tile orders don't match")
+        for tile in tile_order[shared:]:
+            self._add_bit(tile)
+
+    def to_dict(self):
+        """Everything needed to rebuild the tileset, including tile bits, in a form json can store."""
+        return {
+            "tiles": sorted(self.tiles),
+            "rules": {tile: {dir.name: sorted(self.rules.get(tile, {}).get(dir, set())) for dir in sorted(Direction.all_cardinal())}
+                      for tile in sorted(self.tiles)},
+            # Sorted like the rest, so the same tileset always gives the same bytes
+            "colors": dict(sorted(self.colors.items())),
+            "walkability": dict(sorted(self.walkability.items())),
+            "weights": dict(sorted(self.weights.items())),
+            "tile_order": self.tile_order,
+        }
 
     @staticmethod
-    def parse_json(filename: str):
-        with open(filename) as file:
-            our_dict = json.load(file)
+    def from_dict(our_dict: dict):
+        rules = {tile: {Direction[name]: set(allowed) for name, allowed in tile_rules.items()}
+                 for tile, tile_rules in our_dict["rules"].items()}
+        new_tileset = Tileset(set(our_dict["tiles"]), rules, dict(our_dict["colors"]), dict(our_dict["walkability"]),
+                              dict(our_dict.get("weights", {})))
+        new_tileset.match_tile_order(our_dict["tile_order"])
+        return new_tileset
+
+    def fingerprint(self):
+        """A hash of everything that affects generation (the tiles, their rules and their weights)."""
+        rules = {tile: {dir.name: sorted(allowed) for dir, allowed in sorted(self.rules.get(tile, {}).items())}
+                 for tile in sorted(self.tiles)}
+        described = rules
+        if self.weighted:
+            # Unweighted tilesets hash as they did before weights existed
+            described = {"rules": rules, "weights": {tile: self.get_weight(tile) for tile in sorted(self.tiles)}}
+        return hashlib.sha256(json.dumps(described, sort_keys=True).encode()).hexdigest()
+
+    def compiled(self):
+        """The tile order and lookup tables, in a form json can store."""
+        self.rule_masks()
+        return {
+            "tile_order": self.tile_order,
+            "rule_masks": {dir.name: masks for dir, masks in self._rule_masks.items()},
+            "option_tables": {dir.name: table for dir, table in self._option_tables.items()},
+        }
+
+    def load_compiled(self, compiled: dict):
+        """Uses tables from compiled instead of building them, if they match this tileset."""
+        if compiled["tile_order"] != self.tile_order:
+            return False
+        self._rule_masks = {Direction[name]: masks for name, masks in compiled["rule_masks"].items()}
+        self._option_tables = {Direction[name]: table for name, table in compiled["option_tables"].items()}
+        self._options_memo = {dir: {} for dir in self._rule_masks}
+        return True
+
+    @staticmethod
+    def compiled_path(filename: str):
+        return os.path.splitext(filename)[0] + ".compiled.json"
+
+    @staticmethod
+    def parse_json(filename: str, use_compiled: bool = True):
+        """
+            Loads a tileset from a json file. Each tile can have a "weight"
+            (1 if left out) saying how often it's picked.
+            The lookup tables are saved next to it the first time, and used
+            again as long as the file's hash hasn't changed.
+        """
+        with open(filename, "rb") as file:
+            contents = file.read()
+        our_dict = json.loads(contents)
         tiles = set(our_dict.keys())
         new_tileset = Tileset(tiles)
         for tile in tiles:
@@ -97,14 +374,43 @@ class Tileset:
                 new_tileset.add_rule({tile}, directions, set(our_dict[tile]["rules"][direction_key]))
             new_tileset.add_colors({tile: our_dict[tile]["color"]})
             new_tileset.set_walkable({tile}, (our_dict[tile]["isWalkable"] == "True"))
+            if "weight" in our_dict[tile]:
+                new_tileset.set_weights({tile: float(our_dict[tile]["weight"])})
+        if use_compiled:
+            new_tileset.use_compiled_cache(filename, hashlib.sha256(contents).hexdigest())
         return new_tileset
 
+    def use_compiled_cache(self, filename: str, file_hash: str):
+        path = Tileset.compiled_path(filename)
+        try:
+            with open(path) as file:
+                compiled = json.load(file)
+            if (compiled.get("version") == COMPILED_VERSION
+                    and compiled.get("hash") == file_hash
+                    and self.load_compiled(compiled)):
+                return
+        except (OSError, ValueError, KeyError):
+            pass
+        compiled = self.compiled()
+        compiled["version"] = COMPILED_VERSION
+        compiled["hash"] = file_hash
+        def write(temporary: str):
+            with open(temporary, "w") as file:
+                json.dump(compiled, file)
+        try:
+            atomic_write(path, write)
+        except OSError:
+            # Not being able to cache it is fine, it's just slower next time
+            pass
+
 
     def __eq__(self, o):
         if self.tiles != o.tiles:
             return False
         if self.colors != o.colors:
             return False
+        if any(self.get_weight(tile) != o.get_weight(tile) for tile in self.tiles):
+            return False
         for tile in self.rules:
             for direction in self.rules[tile]:
                 if o.rules.get(tile).get(direction) != self.rules[tile][direction]:
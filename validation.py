@@ -0,0 +1,94 @@
+import random
+from collections import namedtuple
+import numpy as np
+from position import Position, Direction
+from map import Map
+from vectorized_wfc import OptionTables, grid_dtype, shift_grid
+
+
+# An edge between the cell at position and its neighbour in direction (E or S)
+# whose tiles aren't allowed next to each other
+Violation = namedtuple("Violation", "position direction tile neighbour repaired", defaults=(False,))
+
+
+def find_violations(map: Map):
+    """
+        Checks every pair of neighbouring cells against the tileset's rules
+        in a few whole-grid operations.
+        An edge is a violation if, in either direction, none of one cell's
+        options allow any of the other's. Cells holding tiles outside the
+        tileset (buttons, goals...) have no rules and are skipped.
+        Each edge is reported once, from its west or north cell.
+    """
+    tileset = map.get_tileset()
+    width, height = map.get_dimensions()
+    dtype = grid_dtype(tileset)
+    tables = OptionTables(tileset, dtype)
+    grid = map.as_numpy().astype(dtype)
+    allowed = {}
+    for table, masks, dirs in tables.groups:
+        options = tables.get_options(grid, table, masks)
+        for dir in dirs:
+            allowed[dir] = options
+    checked = (grid & ~dtype(tileset.all_mask)) == 0
+    violations = []
+    for dir in (Direction.E, Direction.S):
+        dx, dy = dir.get_tuple()
+        # Values of the neighbour in dir, moved onto this cell
+        back = (-dx, -dy)
+        neighbour = shift_grid(grid, back, map.looping, 0)
+        neighbour_allows = shift_grid(allowed[dir.opposite()], back, map.looping, tables.fill)
+        bad = ((neighbour & allowed[dir]) == 0) | ((grid & neighbour_allows) == 0)
+        bad &= checked & shift_grid(checked, back, map.looping, False)
+        if not map.looping:
+            # The last column or row has no neighbour that way
+            bad[height - dy:, :] = False
+            bad[:, width - dx:] = False
+        for y, x in np.argwhere(bad):
+            position = Position(int(x), int(y))
+            violations.append(Violation(position, dir,
+                                        tileset.decode(int(grid[y, x])),
+                                        tileset.decode(int(neighbour[y, x]))))
+    return violations
+
+
+def validate_map(map: Map, repair: bool = False, rng=random):
+    """
+        Returns the violations in map (see find_violations).
+        With repair, the neighbour cell of each violation is changed to a
+        tile that fits all four of its neighbours, if there is one, and the
+        violation is returned with repaired set.
+    """
+    violations = find_violations(map)
+    if not repair:
+        return violations
+    repaired = []
+    for violation in violations:
+        neighbour = violation.position.traverse(violation.direction)
+        # An earlier repair may have fixed this edge already
+        fixed = edge_fits(map, violation.position, violation.direction) or repair_cell(map, neighbour, rng)
+        repaired.append(violation._replace(repaired=fixed))
+    return repaired
+
+
+def edge_fits(map: Map, position: Position, direction: Direction):
+    tileset = map.get_tileset()
+    domain = map.get_domain(position)
+    neighbour = map.get_domain(position.traverse(direction))
+    return (neighbour & tileset.get_options_mask(domain, direction) != 0
+            and domain & tileset.get_options_mask(neighbour, direction.opposite()) != 0)
+
+
+def repair_cell(map: Map, position: Position, rng=random):
+    """Sets position to a random tile its neighbours all allow. Returns whether there was one."""
+    tileset = map.get_tileset()
+    options = tileset.all_mask
+    for dir in map.get_valid_directions(position):
+        neighbour = map.get_domain(position.traverse(dir))
+        if neighbour & ~tileset.all_mask:
+            continue
+        options &= tileset.get_options_mask(neighbour, dir.opposite())
+    if not options:
+        return False
+    map.set_domain(position, tileset.choose(options, rng))
+    return True
@@ -0,0 +1,260 @@
+import random
+import numpy as np
+from position import Position, Direction
+from map import Map
+from tileset import Tileset
+from recovery import Contradiction, RecoveryPolicy
+
+# Passes fall back to whole-grid sweeps once more than 1/DENSE_FRACTION of the cells changed
+DENSE_FRACTION = 8
+
+
+def grid_dtype(tileset: Tileset):
+    bits = len(tileset.tile_order)
+    if bits <= 8:
+        return np.uint8
+    if bits <= 16:
+        return np.uint16
+    if bits <= 32:
+        return np.uint32
+    return np.uint64
+
+
+class OptionTables:
+    """
+        Numpy version of Tileset.get_options_mask, applied to a whole grid of
+        domains at once.
+        Directions with identical rules share one lookup, which for the usual
+        symmetric tilesets means a single lookup per pass.
+        Empty domains allow everything, so a contradiction stays where it
+        happened instead of emptying the rest of the grid.
+    """
+    def __init__(self, tileset: Tileset, dtype):
+        self.dtype = dtype
+        self.fill = np.iinfo(dtype).max
+        rule_masks = tileset.rule_masks()
+        # (table or None, rule masks, directions using them)
+        self.groups: list[tuple[np.ndarray | None, list, list[Direction]]] = []
+        for dir in sorted(Direction.all_cardinal()):
+            for _, masks, dirs in self.groups:
+                if masks == rule_masks[dir]:
+                    dirs.append(dir)
+                    break
+            else:
+                table = tileset.option_table(dir)
+                # Tables built before marker tiles were added don't cover every code
+                if table is not None and len(table) < 1 << len(tileset.tile_order):
+                    table = None
+                if table is not None:
+                    table = np.array(table, dtype=dtype)
+                    table[0] = self.fill
+                self.groups.append((table, list(rule_masks[dir]), [dir]))
+
+    def get_options(self, grid: np.ndarray, table: np.ndarray | None, masks: list[int]):
+        if table is not None:
+            return table[grid]
+        options = np.zeros_like(grid)
+        for index, mask in enumerate(masks):
+            has_tile = (grid & self.dtype(1 << index)) != 0
+            options[has_tile] |= self.dtype(mask)
+        options[grid == 0] = self.fill
+        return options
+
+
+def shift_grid(grid: np.ndarray, offset: tuple[int, int], looping: bool, fill):
+    """
+        Moves every value by offset, so the result at (x, y) is the
+        value that was at (x - dx, y - dy). Cells shifted in from outside a
+        non-looping map get fill.
+    """
+    dx, dy = offset
+    if looping:
+        return np.roll(grid, (dy, dx), axis=(0, 1))
+    height, width = grid.shape
+    shifted = np.full_like(grid, fill)
+    shifted[max(dy, 0):height + min(dy, 0), max(dx, 0):width + min(dx, 0)] = \
+        grid[max(-dy, 0):height + min(-dy, 0), max(-dx, 0):width + min(-dx, 0)]
+    return shifted
+
+
+def propagate_grid(grid: np.ndarray, tables: OptionTables, looping: bool, frozen: np.ndarray, changed: np.ndarray | None = None):
+    """
+        Narrows cells by what their four neighbours allow until nothing
+        changes. Cells marked in frozen are never narrowed.
+        Returns the grid and the number of passes taken.
+        changed holds the flat indices of cells that changed since the grid
+        was last consistent; without it the first pass covers the whole grid.
+        Later passes only look at cells that changed in the pass before,
+        unless that is a large part of the grid.
+    """
+    passes = 0
+    if changed is None:
+        changed = dense_pass(grid, tables, looping, frozen)
+        passes += 1
+    while changed.size:
+        if changed.size > grid.size // DENSE_FRACTION:
+            changed = dense_pass(grid, tables, looping, frozen)
+        else:
+            changed = sparse_pass(grid, tables, looping, frozen, changed)
+        passes += 1
+    return grid, passes
+
+
+def dense_pass(grid: np.ndarray, tables: OptionTables, looping: bool, frozen: np.ndarray):
+    allowed = np.full_like(grid, tables.fill)
+    for table, masks, dirs in tables.groups:
+        options = tables.get_options(grid, table, masks)
+        for dir in dirs:
+            allowed &= shift_grid(options, dir.get_tuple(), looping, tables.fill)
+    allowed[frozen] = tables.fill
+    narrowed = grid & allowed
+    changed = np.flatnonzero(narrowed != grid)
+    grid[...] = narrowed
+    return changed
+
+
+def sparse_pass(grid: np.ndarray, tables: OptionTables, looping: bool, frozen: np.ndarray, changed: np.ndarray):
+    height, width = grid.shape
+    cells = grid.reshape(-1)
+    frozen = frozen.reshape(-1)
+    sources = cells[changed]
+    xs = changed % width
+    ys = changed // width
+    updates = []
+    for table, masks, dirs in tables.groups:
+        options = tables.get_options(sources, table, masks)
+        for dir in dirs:
+            dx, dy = dir.get_tuple()
+            target_xs = xs + dx
+            target_ys = ys + dy
+            if looping:
+                targets = (target_ys % height) * width + target_xs % width
+                target_options = options
+            else:
+                inside = (target_xs >= 0) & (target_xs < width) & (target_ys >= 0) & (target_ys < height)
+                targets = target_ys[inside] * width + target_xs[inside]
+                target_options = options[inside]
+            open_cells = ~frozen[targets]
+            updates.append((targets[open_cells], target_options[open_cells]))
+    touched = np.sort(np.concatenate([targets for targets, _ in updates]))
+    touched = touched[np.concatenate(([True], touched[1:] != touched[:-1]))]
+    before = cells[touched]
+    # Each direction maps sources to distinct targets, so plain fancy
+    # indexing is safe within one update
+    for targets, options in updates:
+        cells[targets] &= options
+    # Only cells that were actually narrowed need another look
+    return touched[cells[touched] != before]
+
+
+def grow(cells: np.ndarray, radius: int, looping: bool):
+    """Expands a boolean mask by radius cells in every direction."""
+    for _ in range(radius):
+        grown = cells.copy()
+        for dir in Direction.all_cardinal():
+            grown |= shift_grid(cells, dir.get_tuple(), looping, False)
+        cells = grown
+    return cells
+
+
+def choose_tiles(domains: np.ndarray, tileset: Tileset, rng: np.random.Generator):
+    """
+        Picks one tile from each domain, in proportion to the tiles'
+        weights, using the tileset's alias table for each distinct domain.
+    """
+    unique, inverse = np.unique(domains, return_inverse=True)
+    tables = [tileset.alias_table(int(mask)) for mask in unique]
+    counts = np.array([len(bits) for bits, _, _ in tables])
+    table = np.zeros((len(unique), counts.max()), dtype=domains.dtype)
+    aliases = np.zeros_like(table)
+    probabilities = np.ones(table.shape)
+    for row, (bits, row_probabilities, row_aliases) in enumerate(tables):
+        table[row, :len(bits)] = bits
+        aliases[row, :len(bits)] = row_aliases
+        if row_probabilities is not None:
+            probabilities[row, :len(bits)] = row_probabilities
+    positions = rng.random(len(domains)) * counts[inverse]
+    picks = positions.astype(np.int64)
+    # With equal weights every probability is 1, so this is a uniform pick
+    keep = positions - picks < probabilities[inverse, picks]
+    return np.where(keep, table[inverse, picks], aliases[inverse, picks])
+
+
+def vectorized_map_generation(map: Map,
+                              limits: tuple[Position, tuple[int, int]] | None = None,
+                              spacing: int = 3,
+                              max_restarts: int = 1000,
+                              recovery: RecoveryPolicy | None = None,
+                              rng=random):
+    """
+        Whole-grid version of map_generation.
+        Each round collapses a lattice of cells spacing apart, so no two of
+        them share a neighbour, then propagates over the grid in one sweep.
+        Cells that end up with no options are reset, along with everything
+        within recovery.restart_radius, and solved again in later rounds.
+        A round failing again grows the area; after max_restarts failures
+        in total, Contradiction is raised.
+    """
+    if recovery is None:
+        recovery = RecoveryPolicy()
+    tileset = map.get_tileset()
+    width, height = map.get_dimensions()
+    dtype = grid_dtype(tileset)
+    tables = OptionTables(tileset, dtype)
+    rng = np.random.default_rng(rng.getrandbits(64))
+    all_mask = dtype(tileset.all_mask)
+    grid = map.as_numpy().astype(dtype)
+    initial = grid.copy()
+
+    if limits is not None:
+        xs = (np.arange(limits[1][0]) + limits[0].x) % width
+        ys = (np.arange(limits[1][1]) + limits[0].y) % height
+        selectable = np.zeros((height, width), dtype=bool)
+        selectable[np.ix_(ys, xs)] = True
+    else:
+        selectable = np.ones((height, width), dtype=bool)
+    # Cells that were already decided are left alone, even by restarts.
+    # Like the scalar engine, they aren't checked against each other either.
+    frozen = (initial & (initial - dtype(1))) == 0
+    selectable &= ~frozen
+    row_phase = np.arange(height)[:, None] % spacing
+    column_phase = np.arange(width)[None, :] % spacing
+
+    grid, _ = propagate_grid(grid, tables, map.looping, frozen)
+    restarts = 0
+    phase = 0
+    idle_phases = 0
+    while idle_phases < spacing * spacing:
+        undecided = selectable & ((grid & (grid - dtype(1))) != 0)
+        batch = undecided & (row_phase == phase // spacing) & (column_phase == phase % spacing)
+        phase = (phase + 1) % (spacing * spacing)
+        if not batch.any():
+            idle_phases += 1
+            continue
+        idle_phases = 0
+        grid[batch] = choose_tiles(grid[batch], tileset, rng)
+        grid, _ = propagate_grid(grid, tables, map.looping, frozen, np.flatnonzero(batch))
+        radius = recovery.restart_radius
+        while True:
+            failed = grid == 0
+            if not failed.any():
+                break
+            recovery.contradictions += int(np.count_nonzero(failed))
+            recovery.restarts += 1
+            restarts += 1
+            if restarts > max_restarts:
+                y, x = np.argwhere(failed)[0]
+                raise Contradiction(Position(int(x), int(y)))
+            # Only undecided cells inside limits are solved again, anything
+            # else goes back to how it was handed in
+            reset = grow(failed, radius, map.looping) & selectable
+            recovery.cells_resolved += int(np.count_nonzero(reset))
+            grid[reset] = all_mask
+            outside = failed & ~selectable
+            grid[outside] = initial[outside]
+            # The reset cells are narrowed again by their neighbours
+            grid, _ = propagate_grid(grid, tables, map.looping, frozen, np.flatnonzero(grow(reset | outside, 1, map.looping)))
+            radius += 1
+
+    map.load_domains(grid.ravel().tolist())
+    return map
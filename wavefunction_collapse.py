@@ -3,95 +3,226 @@ import random
 from position import Position, Direction
 from map import Map
 from tileset import Tileset
-import queue
+from frontier import Frontier
+from recovery import Contradiction, RecoveryPolicy, Trail
 import itertools
-import threading
-import multiprocessing
-import multiprocessing.sharedctypes
-import multiprocessing.shared_memory
-import multiprocessing.managers
+import functools
+import time
+import warnings
+import instrumentation
+from chunk_scheduler import WaveScheduler, run_waves
 
 
-class MyManager(multiprocessing.managers.BaseManager):
-    pass
+# Cardinal directions with their offsets, in the order propagation visits them
+CARDINAL_OFFSETS = [(dir, dir.get_tuple()) for dir in sorted(Direction.all_cardinal())]
 
 
-MyManager.register("Map", Map)
+def map_generation_chunked(tileset: Tileset, dimensions: tuple[int, int], chunk_dimensions: tuple[int, int], regen_entropy: bool = False, num_threads: int = 1, looping = False, engine: str = "scalar", seed: int | None = None, timings: list[tuple[int, float]] | None = None, selection: str = "scanline", stats: list[dict] | None = None):
+    """
+        Generates one chunk, tiles it over the map and regenerates the seams
+        between the copies in parallel, in waves from WaveScheduler.
+        Every job gets its own random stream from seed and its position, so
+        the same seed gives the same map whatever num_threads is.
+        If timings is given, (number of jobs, seconds) is appended to it for
+        each wave. If stats is given, the map's recovery stats are appended
+        to it (see ChunkedGenerator.generate_batch).
+        engine and selection are used for every chunk, see map_generation.
+        Starts and stops its own workers; use ChunkedGenerator to keep them
+        around between maps.
+    """
+    with ChunkedGenerator(tileset, num_threads, engine, selection) as generator:
+        return generator.generate(dimensions, chunk_dimensions, looping, seed, timings, stats)
 
 
-def map_generation_chunked(tileset: Tileset, dimensions: tuple[int, int], chunk_dimensions: tuple[int, int], regen_entropy: bool = False, num_threads: int = 1, looping = False):
-    manager = MyManager()
-    manager.start()
-    map_manager = manager.Map()
+class ChunkedGenerator:
+    """
+        Chunked map generation with a pool of worker processes that is kept
+        between maps, so starting the workers and building the tileset's
+        lookup tables in each of them is only paid for once.
+        Use it as a context manager, or call close when done with it.
+    """
+    def __init__(self, tileset: Tileset, num_threads: int = 1, engine: str = "scalar", selection: str = "scanline"):
+        tileset.rule_masks()
+        self.tileset = tileset
+        self.num_threads = num_threads
+        self.engine = engine
+        self.selection = selection
+        self.pool = None
+        if num_threads > 1:
+            # Only imported when there are workers, so single process
+            # generation starts faster
+            import multiprocessing
+            import multiprocessing.resource_tracker
+            # Workers forked before the resource tracker starts would each
+            # start their own, which then report the grids as leaked
+            multiprocessing.resource_tracker.ensure_running()
+            self.pool = multiprocessing.Pool(num_threads, initializer=load_worker_tileset, initargs=(tileset,))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def generate(self, dimensions: tuple[int, int], chunk_dimensions: tuple[int, int], looping: bool = False, seed: int | None = None, timings: list[tuple[int, float]] | None = None, stats: list[dict] | None = None):
+        return self.generate_batch([(dimensions, chunk_dimensions)], looping, None if seed is None else [seed], timings, stats)[0]
+
+    def generate_batch(self, requests: list[tuple[tuple[int, int], tuple[int, int]]], looping: bool = False, seeds: list[int] | None = None, timings: list[tuple[int, float]] | None = None, stats: list[dict] | None = None):
+        """
+            Generates a map for each (dimensions, chunk dimensions) in
+            requests. The maps' waves go out to the workers together, so
+            small maps still keep every worker busy.
+            A job whose seam can't be matched is tried once more over a
+            wider window, after every wave. One that still fails leaves
+            invalid edges in its map, and a RuntimeWarning says so.
+            If stats is given, a dict per map is appended to it with the
+            RecoveryPolicy counts of the chunk and every job, and how many
+            jobs there were, were retried and were abandoned.
+        """
+        if seeds is None:
+            seeds = [random.getrandbits(64) for _ in requests]
+        maps = [None] * len(requests)
+        map_stats = [None] * len(requests)
+        grids = []
+        schedules = []
+        # (index of the map, its dimensions, job runner) of each schedule
+        owners = []
+        try:
+            for i, ((dimensions, chunk_dimensions), seed) in enumerate(zip(requests, seeds)):
+                recovery = RecoveryPolicy()
+                tiled, jobs = tile_chunk(self.tileset, dimensions, chunk_dimensions, looping, self.engine, seed, self.selection, recovery)
+                maps[i] = tiled
+                map_stats[i] = recovery.stats()
+                map_stats[i].update(jobs=len(jobs), jobs_retried=0, jobs_abandoned=0)
+                if not jobs:
+                    continue
+                if self.pool is None:
+                    # Jobs run in this process, straight on the map
+                    run_job = functools.partial(chunk_worker, tiled, self.tileset, engine=self.engine, seed=seed, selection=self.selection)
+                else:
+                    # Workers attach to the grid by name and copy their
+                    # windows in and out of it directly. They already have
+                    # the tileset loaded.
+                    from shared_grid import SharedGrid
+                    grid = SharedGrid.create(tiled)
+                    grids.append((i, grid))
+                    run_job = functools.partial(chunk_worker, grid.descriptor(), None, engine=self.engine, seed=seed, selection=self.selection)
+                # Jobs in the same wave never touch, so they can't conflict
+                # however the workers interleave
+                schedules.append((WaveScheduler(jobs, dimensions, looping), run_job))
+                owners.append((i, dimensions, run_job))
+            retries = []
+            retry_owners = []
+            for (i, dimensions, run_job), outcomes in zip(owners, run_waves(schedules, self.pool, timings)):
+                failed = add_job_stats(map_stats[i], outcomes)
+                if failed:
+                    map_stats[i]["jobs_retried"] = len(failed)
+                    wider = [widen_job(job, dimensions, looping) for job in failed]
+                    retries.append((WaveScheduler(wider, dimensions, looping), functools.partial(run_job, attempt=1)))
+                    retry_owners.append(i)
+            for i, outcomes in zip(retry_owners, run_waves(retries, self.pool, timings)):
+                abandoned = len(add_job_stats(map_stats[i], outcomes))
+                map_stats[i]["jobs_abandoned"] = abandoned
+                if abandoned:
+                    warnings.warn(f"{abandoned} of {map_stats[i]['jobs']} seams couldn't be matched, "
+                                  "so the map has edges its rules don't allow", RuntimeWarning)
+            for i, grid in grids:
+                maps[i] = grid.to_map(self.tileset)
+        finally:
+            for _, grid in grids:
+                grid.close()
+                grid.unlink()
+        if instrumentation.active is not None:
+            for counts in map_stats:
+                instrumentation.active.count("jobs_retried", counts["jobs_retried"])
+                instrumentation.active.count("jobs_abandoned", counts["jobs_abandoned"])
+        if stats is not None:
+            stats.extend(map_stats)
+        return maps
+
+
+def add_job_stats(totals: dict, outcomes: list[tuple[tuple[Position, tuple[int, int]], dict]]):
+    """Adds the recovery stats chunk_worker returned for each job to totals. Returns the jobs that were abandoned."""
+    failed = []
+    for job, job_stats in outcomes:
+        for name in ("contradictions", "backtracks", "restarts", "cells_resolved"):
+            totals[name] += job_stats[name]
+        if job_stats["abandoned"]:
+            failed.append(job)
+    return failed
+
+
+def widen_job(job: tuple[Position, tuple[int, int]], dimensions: tuple[int, int], looping: bool):
+    """
+        job grown by half its size on every side, for another try at a seam
+        that couldn't be matched. It stays inside a map that isn't looping,
+        and on one that is, leaves room for the window's border.
+    """
+    start = []
+    size = []
+    for pos, length, dimension in zip(job[0], job[1], dimensions):
+        margin = max(length // 2, 1)
+        if looping:
+            wider = max(length, min(length + 2 * margin, dimension - 2))
+            start.append((pos - (wider - length) // 2) % dimension)
+            size.append(wider)
+        else:
+            start.append(max(pos - margin, 0))
+            size.append(min(pos + length + margin, dimension) - start[-1])
+    return (Position(start[0], start[1]), (size[0], size[1]))
+
+
+def tile_chunk(tileset: Tileset, dimensions: tuple[int, int], chunk_dimensions: tuple[int, int], looping: bool, engine: str, seed: int, selection: str = "scanline", recovery: RecoveryPolicy | None = None):
+    """
+        Generates a chunk and tiles it to dimensions.
+        Returns the tiled map and the jobs regenerating the seams between
+        the copies. A map no bigger than a chunk is generated whole, with
+        no jobs left to do. So is a looping map with room for at most one
+        job along a side, as that job's window would wrap onto itself and
+        the seam at the edge would never be checked.
+    """
     chunk = Map()
     chunk.set_dimensions(chunk_dimensions)
     chunk.set_tileset(tileset)
     # map_manager = Map.new(chunk_dimensions, tileset, looping=True)
-    if chunk_dimensions[0] >= dimensions[0] and chunk_dimensions[1] >= dimensions[1]:
+    regen_offset = (chunk_dimensions[0] // 2, chunk_dimensions[1] // 2)
+    too_narrow = looping and (dimensions[0] <= regen_offset[0] + chunk_dimensions[0]
+                              or dimensions[1] <= regen_offset[1] + chunk_dimensions[1])
+    if (chunk_dimensions[0] >= dimensions[0] and chunk_dimensions[1] >= dimensions[1]) or too_narrow:
         chunk.looping = looping
         chunk.tile_to_dimensions(dimensions)
-        return map_generation(chunk, regen_entropy=regen_entropy)
-    map_generation(chunk)
+        return map_generation(chunk, engine=engine, selection=selection, recovery=recovery, seed=seed), []
+    # Generating the chunk as looping means the copies tiled next to
+    # each other line up, so jobs never start from a conflicting border
+    chunk.looping = True
+    map_generation(chunk, engine=engine, selection=selection, recovery=recovery, seed=seed)
     chunk.looping = looping
     chunk.tile_to_dimensions(dimensions)
     
-    regen_offset = (chunk_dimensions[0] // 2, chunk_dimensions[1] // 2)
     x_pos_list = [(x, chunk_dimensions[0]) for x in range(regen_offset[0], dimensions[0], chunk_dimensions[0])]
     y_pos_list = [(y, chunk_dimensions[1]) for y in range(regen_offset[1], dimensions[1], chunk_dimensions[1])]
-    x_pos_list = map(lambda x: job_trimmer(x, dimensions[0], regen_offset[0], looping), x_pos_list)
-    y_pos_list = map(lambda y: job_trimmer(y, dimensions[1], regen_offset[1], looping), y_pos_list)
+    x_pos_list = list(map(lambda x: job_trimmer(x, dimensions[0], regen_offset[0], looping), x_pos_list))
+    y_pos_list = list(map(lambda y: job_trimmer(y, dimensions[1], regen_offset[1], looping), y_pos_list))
+    if looping:
+        # The last job wraps around to where the first one starts,
+        # so the seam at the edge of the map is always regenerated
+        x_pos_list[-1] = (x_pos_list[-1][0], dimensions[0] + regen_offset[0] - x_pos_list[-1][0])
+        y_pos_list[-1] = (y_pos_list[-1][0], dimensions[1] + regen_offset[1] - y_pos_list[-1][0])
     if not looping:
-        x_pos_list = itertools.chain([(0, regen_offset[0])], x_pos_list)
-        y_pos_list = itertools.chain([(0, regen_offset[1])], y_pos_list)
+        # Trimmed too, as the offset is past the edge of a map less than
+        # half a chunk across
+        x_pos_list = itertools.chain([job_trimmer((0, regen_offset[0]), dimensions[0], regen_offset[0], looping)], x_pos_list)
+        y_pos_list = itertools.chain([job_trimmer((0, regen_offset[1]), dimensions[1], regen_offset[1], looping)], y_pos_list)
 
     jobs_list = itertools.product(x_pos_list, y_pos_list)
-    jobs_list = list(map(job_zipper, jobs_list))
-    # Avoid using too many threads
-    # job_thread_factor = 1024 // (chunk_dimensions[0] * chunk_dimensions[1])
-    # if len(jobs_list) < num_threads * job_thread_factor:
-    #     num_threads = max(len(jobs_list) // job_thread_factor, 1)
-
-    # This is required to ensure threads are less likely to work
-    # on neighboring chunks, which could lead to conflicts.
-    # I wish there was an easier way to checkerboard it like this.
-    jobs_list_even = []
-    jobs_list_odd = []
-    old_y = -1
-    last_even = False
-    last_row_even = False
-
-    for job in jobs_list:
-        if job[0].y != old_y:
-            old_y = job[0].y
-            last_even = last_row_even
-            last_row_even = not last_row_even
-        if last_even:
-            jobs_list_odd.append(job)
-        else:
-            jobs_list_even.append(job)
-    jobs = multiprocessing.Queue()
-    for job in jobs_list_even:
-        jobs.put(job)
-    for job in jobs_list_odd:
-        jobs.put(job)
-    # print("printing jobs queue")
-    # while not jobs.empty():
-    #     print(jobs.get())
-    # print("printed jobs queue")
-    
-    map_manager.self_from_map(chunk)
-    processes = []
-    for i in range(num_threads):
-        processes.append(multiprocessing.Process(target=lambda: chunk_worker(map_manager, jobs), name=f"Thread-{i}"))
-    for process in processes:
-        process.start()
-    for process in processes:
-        process.join()
-    jobs.close()
-    jobs.join_thread()
-    return_map = map_manager.get_self_as_map()
-    manager.shutdown()
-    return return_map
+    return chunk, list(map(job_zipper, jobs_list))
+
 
 def job_trimmer(job, dimension, offset, looping):
     pos = job[0]
@@ -101,34 +232,86 @@ def job_trimmer(job, dimension, offset, looping):
 def job_zipper(job):
     return (Position(job[0][0], job[1][0]), (job[0][1], job[1][1]))
 
-def chunk_worker(map, jobs):
-    # label = multiprocessing.current_process().name
-    map_dimensions = map.get_dimensions()
-    while True:
+def chunk_rng(seed: int, x: int, y: int, attempt: int = 0):
+    """
+        The random stream for the chunk at (x, y) of whatever seed generates.
+        Streams only depend on their inputs, not on which process asks or
+        in what order, and different chunks' streams are independent.
+        Each later attempt at a chunk gets a stream of its own.
+    """
+    if attempt:
+        return random.Random(f"{seed}:{x}:{y}:{attempt}")
+    return random.Random(f"{seed}:{x}:{y}")
+
+
+# The tileset a pool worker was started with, see load_worker_tileset
+worker_tileset = None
+
+
+def load_worker_tileset(tileset: Tileset):
+    global worker_tileset
+    tileset.rule_masks()
+    worker_tileset = tileset
+    # Only jobs sent with instrumentation on record anything (see run_waves)
+    instrumentation.disable()
+
+
+def chunk_worker(grid_descriptor: tuple | Map, tileset: Tileset | None, job: tuple[Position, tuple[int, int]], engine: str = "scalar", seed: int = 0, selection: str = "scanline", attempt: int = 0):
+    """
+        Regenerates one job's window of the shared grid, or of a map when
+        running in the same process as it.
+        Without a tileset, the one the worker was started with is used.
+        Returns the job's RecoveryPolicy stats, with "abandoned" set if its
+        border couldn't be matched and the window was left as it was.
+    """
+    if tileset is None:
+        tileset = worker_tileset
+    if isinstance(grid_descriptor, Map):
+        grid = grid_descriptor
+        read_patch = grid.get_patch
+        write_patch = grid.apply_patch
+    else:
+        from shared_grid import SharedGrid
+        grid = SharedGrid.attach(grid_descriptor)
+        read_patch = functools.partial(grid.read_patch, tileset=tileset)
+        write_patch = grid.write_patch
+    map_dimensions = grid.dimensions
+    rng = chunk_rng(seed, job[0].x, job[0].y, attempt)
+    recovery = RecoveryPolicy()
+    # Windows wrap on a looping map, so there is always a border to read
+    x_adjust = 0 if job[0].x == 0 and not grid.looping else 1
+    y_adjust = 0 if job[0].y == 0 and not grid.looping else 1
+    end_x_adjust = 1 if job[0].x + job[1][0] < map_dimensions[0] - 1 or grid.looping else 0
+    end_y_adjust = 1 if job[0].y + job[1][1] < map_dimensions[1] - 1 or grid.looping else 0
+    try:
+        patch = read_patch(Position(job[0].x - x_adjust, job[0].y - y_adjust), (job[1][0] + x_adjust + end_x_adjust, job[1][1] + y_adjust + end_y_adjust))
         try:
-            job = jobs.get(timeout=0.2)
-        except (queue.Empty, OSError, EOFError):
-            break
-        # print(f"Thread {label} working job {job}")
-        x_adjust = 0 if job[0].x == 0 else 1
-        y_adjust = 0 if job[0].y == 0 else 1
-        end_x_adjust = 1 if job[0].x + job[1][0] < map_dimensions[0] - 1 else 0
-        end_y_adjust = 1 if job[0].y + job[1][1] < map_dimensions[1] - 1 else 0
-        patch = map.get_patch(Position(job[0].x - x_adjust, job[0].y - y_adjust), (job[1][0] + x_adjust + end_x_adjust, job[1][1] + y_adjust + end_y_adjust))
-        remove_section_and_repropagate(patch, Position(x_adjust, y_adjust), job[1])
-        map_generation(patch, regen_entropy=True)
+            remove_section_and_repropagate(patch, Position(x_adjust, y_adjust), job[1])
+            map_generation(patch, regen_entropy=True, engine=engine, selection=selection, recovery=recovery, rng=rng)
+        except Contradiction:
+            # The border can't be matched, keep what was there before
+            if not recovery.contradictions:
+                # It failed while propagating the border in, before
+                # map_generation had anything to count
+                recovery.contradictions += 1
+            if instrumentation.active is not None:
+                instrumentation.active.count("job_attempts_failed")
+            return dict(recovery.stats(), abandoned=True)
         patch_to_apply = patch.get_patch(Position(x_adjust, y_adjust), (patch.dimensions[0] - x_adjust - end_x_adjust, patch.dimensions[1] - y_adjust - end_y_adjust))
-        map.apply_patch(Position(job[0].x, job[0].y), patch_to_apply)
-        # print(f"Thread {label} finished job {job}")
-    # print(f"No more jobs in queue. Killing thread {label}")
+        write_patch(Position(job[0].x, job[0].y), patch_to_apply)
+        return dict(recovery.stats(), abandoned=False)
+    finally:
+        if grid is not grid_descriptor:
+            grid.close()
 
 
 def remove_section_and_repropagate(map: Map, pos: Position, dimensions: tuple[int, int]):
     end_pos = pos + (dimensions[0] - 1, dimensions[1] - 1)
+    all_mask = map.get_tileset().all_mask
     for i in range(dimensions[0]):
         for j in range(dimensions[1]):
             target = pos + (i, j)
-            map.set_tile(target, map.get_tileset().tiles)
+            map.set_domain(target, all_mask)
     if pos.y > 0 or map.looping:
         for i in range(dimensions[0]):
             target = pos + (i, -1)
@@ -147,43 +330,278 @@ def remove_section_and_repropagate(map: Map, pos: Position, dimensions: tuple[in
             propagate_collapse(map, target, limit_directions={Direction.W})
 
 
-def map_generation(map: Map, limits: tuple[Position, tuple[int, int]] | None = None, regen_entropy: bool = False):
+def map_generation(map: Map, limits: tuple[Position, tuple[int, int]] | None = None, regen_entropy: bool = False, step_counts: list[int] | None = None, engine: str = "scalar", selection: str = "scanline", weights: dict[str, float] | None = None, recovery: RecoveryPolicy | None = None, rng=random, seed: int | None = None):
+    """
+        Collapses every undecided cell in limits (the whole map by default).
+        If step_counts is given, the number of propagation steps caused by
+        each collapse is appended to it.
+        engine is "scalar" (cell by cell) or "numpy" (whole-grid sweeps, see
+        vectorized_wfc).
+        selection picks the next cell for the scalar engine: "scanline" goes
+        in raster order, "domain_size" and "entropy" always take the most
+        constrained cell (see frontier.Frontier).
+        Tiles are picked, and entropy worked out, using the tileset's
+        weights, unless weights is given to use instead.
+        Contradictions are recovered from as described by recovery, which
+        also counts them. Contradiction is only raised once that gives up.
+        Every random choice comes from rng, so passing a seeded
+        random.Random, or a seed to make one from, makes the result
+        reproducible.
+        While instrumentation is on, the time taken, collapses,
+        propagation and contradictions are recorded (see instrumentation).
+    """
+    if seed is not None:
+        rng = random.Random(seed)
+    if recovery is None:
+        recovery = RecoveryPolicy()
+    if instrumentation.active is not None:
+        start = time.perf_counter()
+        try:
+            return generate_cells(map, limits, step_counts, engine, selection, weights, recovery, rng)
+        finally:
+            instrumentation.active.add_time("map_generation", time.perf_counter() - start)
+    return generate_cells(map, limits, step_counts, engine, selection, weights, recovery, rng)
+
+
+def generate_cells(map: Map, limits: tuple[Position, tuple[int, int]] | None, step_counts: list[int] | None, engine: str, selection: str, weights: dict[str, float] | None, recovery: RecoveryPolicy, rng):
+    if engine == "numpy":
+        from vectorized_wfc import vectorized_map_generation
+        return vectorized_map_generation(map, limits, recovery=recovery, rng=rng)
+    if engine != "scalar":
+        raise ValueError(f"Unknown engine {engine}")
     if limits is not None:
         offset = limits[0]
         dimensions = limits[1]
     else:
         offset = Position(0, 0)
         dimensions = map.get_dimensions()
+    domains = map.original_tiles
+    # Only cells that start out undecided may be reset by a restart
+    open_cells = bytearray(len(domains))
+    cells = []
     for i in range(dimensions[0]):
         for j in range(dimensions[1]):
-            target = Position(i, j) + offset
-            tile_options = map.get_tile(target)
-            if isinstance(tile_options, set):
-                choice = random.choice(list(tile_options))
-                map.set_tile(target, choice)
-                propagate_collapse(map, target, None)
+            index = map.index(Position(i, j) + offset)
+            tile_options = domains[index]
+            # More than one bit set means the cell is still undecided
+            if tile_options & (tile_options - 1):
+                open_cells[index] = 1
+                cells.append(index)
+    frontier = None
+    if selection != "scanline":
+        frontier = Frontier(map.get_tileset(), selection, weights, rng, open_cells)
+        for index in cells:
+            frontier.update(index, domains[index])
+    for index in (cells if frontier is None else frontier_order(frontier)):
+        tile_options = domains[index]
+        if tile_options & (tile_options - 1):
+            steps = collapse_cell(map, index, weights, recovery, open_cells, frontier, rng)
+            if step_counts is not None:
+                step_counts.append(steps)
     return map
 
 
-def propagate_collapse(map: Map, position: Position, direction: Direction | None = None, limit_directions: set[Direction] | None = None):
-    try:
-        prop_source = map.get_tile(position)
-    except:
-        print(position)
-        print(map.get_dimensions())
-    iter_directions = map.get_valid_directions(position)
-    iter_directions -= {direction}
-    if limit_directions is not None:
-        iter_directions = iter_directions.intersection(limit_directions)
-    for dir in iter_directions:
-        target = position.traverse(dir)
-        target_options = map.get_tile(target)
-        if isinstance(target_options, set):
-            new_options = target_options.intersection(map.get_tileset().get_options(prop_source, dir))
-            if len(new_options) == 0:
-                print(f"Problem at position {target}. Tried to intersect with {map.get_tileset().get_options(prop_source, dir)}")
-                map.print_debug()
-                raise ValueError
-            map.set_tile(target, new_options)
+def frontier_order(frontier: Frontier):
+    while len(frontier) > 0:
+        yield frontier.pop()
+
+
+def choose_tile(tileset: Tileset, tile_options: int, weights: dict[str, float] | None, rng=random):
+    """Picks a tile using the tileset's weights, or weights instead if given."""
+    if weights is None:
+        return tileset.choose(tile_options, rng)
+    bits = tileset.bit_choices(tile_options)
+    return rng.choices(bits, [weights.get(tileset.decode(bit), 1.0) for bit in bits])[0]
+
+
+def set_cell(map: Map, index: int, mask: int, trail: Trail, frontier: Frontier | None):
+    trail.record(index, map.original_tiles[index])
+    map.set_domain_index(index, mask)
+    if frontier is not None:
+        frontier.update(index, mask)
+
+
+def collapse_cell(map: Map, index: int, weights: dict[str, float] | None, recovery: RecoveryPolicy, open_cells: bytearray, frontier: Frontier | None, rng=random, depth: int = 0):
+    """
+        Picks a tile for the cell at index and propagates it.
+        If that leads to a contradiction the pick is undone and banned,
+        and once that has happened too often the area around the failure is
+        solved again. Returns the number of propagation steps taken.
+    """
+    tileset = map.get_tileset()
+    domains = map.original_tiles
+    trail = recovery.trail
+    width = map.get_dimensions()[0]
+    position = Position(index % width, index // width)
+    backtracks = 0
+    steps = 0
+    while True:
+        tile_options = domains[index]
+        if not tile_options & (tile_options - 1):
+            return steps
+        choice = choose_tile(tileset, tile_options, weights, rng)
+        if instrumentation.active is not None:
+            instrumentation.active.count("collapses")
+        trail.clear()
+        set_cell(map, index, choice, trail, frontier)
+        try:
+            return steps + propagate_collapse(map, position, trail=trail, frontier=frontier)
+        except Contradiction as contradiction:
+            recovery.contradictions += 1
+            count_contradiction()
+            trail.undo(map, frontier)
+            failure = contradiction.position
+        if backtracks < recovery.max_backtracks:
+            backtracks += 1
+            recovery.backtracks += 1
+            set_cell(map, index, tile_options & ~choice, trail, frontier)
+            try:
+                steps += propagate_collapse(map, position, trail=trail, frontier=frontier)
+                continue
+            except Contradiction as contradiction:
+                recovery.contradictions += 1
+                count_contradiction()
+                trail.undo(map, frontier)
+                failure = contradiction.position
+        restart_area(map, failure, weights, recovery, open_cells, frontier, rng, depth)
+        return steps
+
+
+def restart_area(map: Map, failure: Position, weights: dict[str, float] | None, recovery: RecoveryPolicy, open_cells: bytearray, frontier: Frontier | None, rng, depth: int):
+    """
+        Resets the undecided cells around failure, narrows them again from
+        their surroundings and collapses them one by one.
+    """
+    if depth >= recovery.max_depth:
+        raise Contradiction(failure)
+    all_mask = map.get_tileset().all_mask
+    trail = recovery.trail
+    width, height = map.get_dimensions()
+    radius = recovery.restart_radius + depth
+    for _ in range(recovery.max_restarts):
+        recovery.restarts += 1
+        if instrumentation.active is not None:
+            instrumentation.active.count("restarts")
+        area = set()
+        for dx in range(-radius, radius + 1):
+            for dy in range(-radius, radius + 1):
+                x = failure.x + dx
+                y = failure.y + dy
+                if not map.looping and not (0 <= x < width and 0 <= y < height):
+                    continue
+                index = map.index(Position(x, y))
+                if open_cells[index]:
+                    area.add(index)
+        trail.clear()
+        for index in area:
+            set_cell(map, index, all_mask, trail, frontier)
+        try:
+            for index in area:
+                for dir, neighbour in cardinal_neighbours(map, index):
+                    if neighbour not in area:
+                        propagate_collapse(map, Position(neighbour % width, neighbour // width), limit_directions={dir.opposite()}, trail=trail, frontier=frontier)
+        except Contradiction:
+            recovery.contradictions += 1
+            count_contradiction()
+            trail.undo(map, frontier)
+            radius += 1
+            continue
+        recovery.cells_resolved += len(area)
+        for index in sorted(area):
+            collapse_cell(map, index, weights, recovery, open_cells, frontier, rng, depth + 1)
+        return
+    raise Contradiction(failure)
+
+
+def count_contradiction():
+    if instrumentation.active is not None:
+        instrumentation.active.count("contradictions")
+
+
+def cardinal_neighbours(map: Map, index: int):
+    width, height = map.get_dimensions()
+    x = index % width
+    y = index // width
+    for dir, (dx, dy) in CARDINAL_OFFSETS:
+        target_x = x + dx
+        target_y = y + dy
+        if map.looping:
+            target_x %= width
+            target_y %= height
+        elif not (0 <= target_x < width and 0 <= target_y < height):
+            continue
+        yield dir, target_y * width + target_x
+
+
+def propagate_collapse(map: Map, position: Position, direction: Direction | None = None, limit_directions: set[Direction] | None = None, frontier: Frontier | None = None, trail: Trail | None = None):
+    """
+        Propagates the domain at position to the rest of the map.
+        Cells whose domain changes are put on a worklist (once, however many
+        times they change while waiting) and processed until it runs dry.
+        If a frontier is given it is told about every changed cell, and if a
+        trail is given every change is recorded on it.
+        Raises Contradiction if a cell runs out of options.
+        Returns the number of cells processed.
+    """
+    tileset = map.get_tileset()
+    domains = map.original_tiles
+    width, height = map.get_dimensions()
+    looping = map.looping
+    start = map.index(position)
+    worklist = [start]
+    queued = {start}
+    steps = 0
+    # Neighbours not looked at, so the intersections made can be counted
+    # without adding work to the loop
+    skipped = 0
+    changes = 0
+    # direction and limit_directions only restrict the first cell
+    first = True
+    while worklist:
+        index = worklist.pop()
+        queued.discard(index)
+        steps += 1
+        prop_source = domains[index]
+        x = index % width
+        y = index // width
+        for dir, (dx, dy) in CARDINAL_OFFSETS:
+            if first and (dir == direction or (limit_directions is not None and dir not in limit_directions)):
+                skipped += 1
+                continue
+            target_x = x + dx
+            target_y = y + dy
+            if looping:
+                target_x %= width
+                target_y %= height
+            elif not (0 <= target_x < width and 0 <= target_y < height):
+                skipped += 1
+                continue
+            target_index = target_y * width + target_x
+            target_options = domains[target_index]
+            new_options = target_options & tileset.get_options_mask(prop_source, dir)
+            if new_options == 0:
+                if instrumentation.active is not None:
+                    count_propagation(steps, steps * len(CARDINAL_OFFSETS) - skipped, changes)
+                raise Contradiction(Position(target_x, target_y))
             if new_options != target_options:
-                propagate_collapse(map, target, dir.opposite())
+                changes += 1
+                if trail is not None:
+                    trail.record(target_index, target_options)
+                map.set_domain_index(target_index, new_options)
+                if frontier is not None:
+                    frontier.update(target_index, new_options)
+                if target_index not in queued:
+                    queued.add(target_index)
+                    worklist.append(target_index)
+        first = False
+    if instrumentation.active is not None:
+        count_propagation(steps, steps * len(CARDINAL_OFFSETS) - skipped, changes)
+    return steps
+
+
+def count_propagation(steps: int, intersections: int, changes: int):
+    metrics = instrumentation.active
+    metrics.count("propagations")
+    metrics.count("propagation_steps", steps)
+    metrics.count("domain_intersections", intersections)
+    metrics.count("domains_narrowed", changes)
@@ -0,0 +1,185 @@
+import os
+import random
+import shutil
+import sys
+import tempfile
+from array import array
+from collections import OrderedDict
+from position import Position
+from map import Map
+from tileset import Tileset
+from recovery import Contradiction
+from wavefunction_collapse import map_generation, remove_section_and_repropagate, chunk_rng
+
+
+class World:
+    """
+        A map with no edges, made of chunks that are generated the first
+        time something inside them is asked for.
+        A new chunk starts from the edges of the neighbouring chunks that
+        already exist, so it lines up with them. Which neighbours exist
+        depends on the order chunks are visited in, so the same seed only
+        gives the same world for the same order.
+        At most memory_budget bytes of chunks are kept in memory. The least
+        recently used ones are written to cache_dir (a temporary directory
+        by default) and read back when needed again.
+    """
+    def __init__(self, tileset: Tileset, chunk_dimensions: tuple[int, int] = (32, 32), seed: int | None = None, memory_budget: int = 64 * 1024 * 1024, cache_dir: str | None = None, engine: str = "scalar", attempts: int = 4):
+        self.tileset = tileset
+        self.chunk_dimensions = chunk_dimensions
+        self.seed = seed if seed is not None else random.getrandbits(64)
+        self.memory_budget = memory_budget
+        self.engine = engine
+        self.attempts = attempts
+        self.owns_cache_dir = cache_dir is None
+        self.cache_dir = cache_dir if cache_dir is not None else tempfile.mkdtemp(prefix="world-")
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Resident chunks, least recently used first
+        self.chunks: OrderedDict[tuple[int, int], Map] = OrderedDict()
+        self.resident_bytes = 0
+        # Typecode of each chunk that was evicted, and so is only on disk.
+        # The tileset's typecode can grow after a chunk is written, as
+        # marker tiles get encoded
+        self.stored: dict[tuple[int, int], str] = {}
+        self.generated = 0
+        self.loaded = 0
+        self.evicted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """Drops every chunk, and the cache directory if the world made it."""
+        self.chunks.clear()
+        self.resident_bytes = 0
+        self.stored.clear()
+        if self.owns_cache_dir:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def chunk_coordinates(self, pos: Position):
+        """The chunk pos is in, and where in that chunk it is."""
+        width, height = self.chunk_dimensions
+        return (pos.x // width, pos.y // height), Position(pos.x % width, pos.y % height)
+
+    def get_domain(self, pos: Position):
+        coordinates, local = self.chunk_coordinates(pos)
+        return self.get_chunk(*coordinates).get_domain(local)
+
+    def get_tile(self, pos: Position):
+        return self.tileset.decode(self.get_domain(pos))
+
+    def get_region(self, pos: Position, dimensions: tuple[int, int]):
+        """Copies a rectangle of the world into a new map, generating chunks as needed."""
+        region = Map.new(dimensions, self.tileset)
+        width, height = self.chunk_dimensions
+        (first_x, first_y), _ = self.chunk_coordinates(pos)
+        (last_x, last_y), _ = self.chunk_coordinates(pos + (dimensions[0] - 1, dimensions[1] - 1))
+        for cy in range(first_y, last_y + 1):
+            for cx in range(first_x, last_x + 1):
+                chunk = self.get_chunk(cx, cy)
+                # The part of the chunk inside the region, in chunk coordinates
+                x0 = max(pos.x - cx * width, 0)
+                y0 = max(pos.y - cy * height, 0)
+                x1 = min(pos.x + dimensions[0] - cx * width, width)
+                y1 = min(pos.y + dimensions[1] - cy * height, height)
+                piece = chunk.get_patch(Position(x0, y0), (x1 - x0, y1 - y0))
+                region.apply_patch(Position(cx * width + x0 - pos.x, cy * height + y0 - pos.y), piece)
+        return region
+
+    def get_chunk(self, cx: int, cy: int):
+        """The chunk at chunk coordinates (cx, cy), generated or loaded if needed."""
+        key = (cx, cy)
+        chunk = self.chunks.get(key)
+        if chunk is not None:
+            self.chunks.move_to_end(key)
+            return chunk
+        if key in self.stored:
+            chunk = self.load_chunk(key)
+            self.loaded += 1
+        else:
+            chunk = self.generate_chunk(cx, cy)
+            self.generated += 1
+        self.make_resident(key, chunk)
+        return chunk
+
+    def existing_chunk(self, cx: int, cy: int):
+        """Like get_chunk, but never generates. Returns None for chunks that don't exist yet."""
+        key = (cx, cy)
+        if key in self.chunks or key in self.stored:
+            return self.get_chunk(cx, cy)
+        return None
+
+    def generate_chunk(self, cx: int, cy: int):
+        width, height = self.chunk_dimensions
+        # The chunk plus a one cell border holding the neighbours' edges
+        patch = Map.new((width + 2, height + 2), self.tileset)
+        for (dx, dy), cells in [((0, -1), [(Position(x, height - 1), Position(x + 1, 0)) for x in range(width)]),
+                                ((0, 1), [(Position(x, 0), Position(x + 1, height + 1)) for x in range(width)]),
+                                ((-1, 0), [(Position(width - 1, y), Position(0, y + 1)) for y in range(height)]),
+                                ((1, 0), [(Position(0, y), Position(width + 1, y + 1)) for y in range(height)])]:
+            neighbour = self.existing_chunk(cx + dx, cy + dy)
+            if neighbour is None:
+                continue
+            for source, target in cells:
+                patch.set_domain(target, neighbour.get_domain(source))
+        # Every chunk has its own random stream, so a chunk only depends on
+        # the seed, where it is and the neighbours it was fitted to
+        rng = chunk_rng(self.seed, cx, cy)
+        for attempt in range(self.attempts):
+            if attempt == self.attempts - 1:
+                # The neighbours' edges can't all be matched, so the chunk
+                # is generated on its own and leaves a seam
+                patch.load_domains([self.tileset.all_mask] * len(patch.original_tiles))
+            try:
+                remove_section_and_repropagate(patch, Position(1, 1), self.chunk_dimensions)
+                map_generation(patch, limits=(Position(1, 1), self.chunk_dimensions), engine=self.engine, rng=rng)
+                break
+            except Contradiction:
+                if attempt == self.attempts - 1:
+                    raise
+        return patch.get_patch(Position(1, 1), self.chunk_dimensions)
+
+    def chunk_bytes(self, chunk: Map):
+        return sys.getsizeof(chunk.original_tiles) + sys.getsizeof(chunk.visual_overlay)
+
+    def make_resident(self, key: tuple[int, int], chunk: Map):
+        self.chunks[key] = chunk
+        self.resident_bytes += self.chunk_bytes(chunk)
+        # The newest chunk always stays, whatever the budget
+        while self.resident_bytes > self.memory_budget and len(self.chunks) > 1:
+            self.evict()
+
+    def evict(self):
+        """Writes the least recently used chunk to disk and drops it."""
+        key, chunk = self.chunks.popitem(last=False)
+        self.resident_bytes -= self.chunk_bytes(chunk)
+        if key not in self.stored:
+            # Chunks never change once generated, so one write is enough
+            codes = array(self.tileset.code_typecode(), chunk.original_tiles)
+            with open(self.chunk_path(key), "wb") as chunk_file:
+                codes.tofile(chunk_file)
+            self.stored[key] = codes.typecode
+        self.evicted += 1
+
+    def load_chunk(self, key: tuple[int, int]):
+        width, height = self.chunk_dimensions
+        codes = array(self.stored[key])
+        with open(self.chunk_path(key), "rb") as chunk_file:
+            codes.fromfile(chunk_file, width * height)
+        return Map.from_codes(self.chunk_dimensions, self.tileset, codes)
+
+    def chunk_path(self, key: tuple[int, int]):
+        return os.path.join(self.cache_dir, f"{key[0]}_{key[1]}.chunk")
+
+    def stats(self):
+        return {
+            "resident": len(self.chunks),
+            "resident_bytes": self.resident_bytes,
+            "stored": len(self.stored),
+            "generated": self.generated,
+            "loaded": self.loaded,
+            "evicted": self.evicted,
+        }